@@ -0,0 +1,114 @@
+"""Compare parse_post throughput of the html2text parser and the extractor,
+with each POSTS_CONTENT_FORMAT.
+
+Run it over a directory of saved post pages, e.g.
+
+    python bin/bench_parse_post.py saved_posts/ --repeat 5
+"""
+import argparse
+import os
+import time
+from datetime import datetime
+
+from scrapy.http import HtmlResponse
+from scrapy.utils.test import get_crawler
+
+from ptt_crawler.spiders.posts import CONTENT_FORMATS
+from ptt_crawler.spiders.posts import PostsSpider
+
+
+def legacy_parse_post(response):
+    """parse_post before the single-pass extractor, kept for comparison."""
+    import html2text
+
+    item = {}
+    item["title"] = response.xpath('//meta[@property="og:title"]/@content')[
+        0
+    ].extract()
+    item["author"] = (
+        response.xpath(
+            '//div[@class="article-metaline"]/span[text()="作者"]/following-sibling::span[1]/text()'
+        )[0]
+        .extract()
+        .split(" ")[0]
+    )
+    datetime_str = response.xpath(
+        '//div[@class="article-metaline"]/span[text()="時間"]/following-sibling::span[1]/text()'
+    )[0].extract()
+    item["date"] = datetime.strptime(datetime_str, "%a %b %d %H:%M:%S %Y")
+
+    converter = html2text.HTML2Text()
+    converter.ignore_links = True
+    item["content"] = converter.handle(
+        response.xpath('//div[@id="main-content"]')[0].extract()
+    )
+
+    comments = []
+    total_score = 0
+    for comment in response.xpath('//div[@class="push"]'):
+        push_tag = comment.css("span.push-tag::text")[0].extract()
+        push_user = comment.css("span.push-userid::text")[0].extract()
+        push_content = comment.css("span.push-content::text")[0].extract()
+
+        if "推" in push_tag:
+            score = 1
+        elif "噓" in push_tag:
+            score = -1
+        else:
+            score = 0
+
+        total_score += score
+
+        comments.append({"user": push_user, "content": push_content, "score": score})
+
+    item["comments"] = comments
+    item["score"] = total_score
+    item["file_urls"] = response.xpath(
+        '//a[contains(@href, "imgur.com")]/@href'
+    ).extract()
+    return item
+
+
+def load_pages(input_dir):
+    pages = []
+    for name in sorted(os.listdir(input_dir)):
+        with open(os.path.join(input_dir, name), "rb") as infile:
+            pages.append((name, infile.read()))
+    return pages
+
+
+def bench(name, parse, pages, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for page_name, body in pages:
+            # a fresh response per run so that no parsed tree is reused
+            response = HtmlResponse(
+                "http://ptt.cc/bbs/Test/{}".format(page_name),
+                body=body,
+                encoding="utf-8",
+            )
+            for _item in parse(response):
+                pass
+    elapsed = time.perf_counter() - start
+    posts = len(pages) * repeat
+    print("{:>10}: {:8.1f} posts/sec ({} posts)".format(name, posts / elapsed, posts))
+    return posts / elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("input_dir", help="Directory of saved post HTML files.")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    pages = load_pages(args.input_dir)
+    before = bench("legacy", lambda r: [legacy_parse_post(r)], pages, args.repeat)
+    for content_format in CONTENT_FORMATS:
+        crawler = get_crawler(PostsSpider, {"POSTS_CONTENT_FORMAT": content_format})
+        spider = PostsSpider.from_crawler(crawler)
+        after = bench(content_format, spider.parse_post, pages, args.repeat)
+        print("{:>10}: {:8.2f}x".format("speedup", after / before))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""Replay saved PTT pages through the spider callbacks and report throughput.
+
+The corpus directory holds saved index pages (index*.html) and post pages
+(M.*.html), either flat or in one sub-directory per board. Posts are grouped
+into small, medium and huge by their number of pushes, e.g.
+
+    python bin/benchmark_parse.py corpus/ --output results.json
+    python bin/benchmark_parse.py corpus/ --compare results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+import scrapy
+from scrapy.http import HtmlResponse
+from scrapy.utils.test import get_crawler
+
+from ptt_crawler.spiders.posts import PostsSpider
+
+URL_FORMAT = "http://ptt.cc/bbs/{board_name}/{name}"
+SIZE_LIMITS = [("small", 100), ("medium", 1000), ("huge", None)]
+
+
+def size_class(body):
+    pushes = body.count(b'<div class="push">')
+    for name, limit in SIZE_LIMITS:
+        if limit is None or pushes < limit:
+            return name
+
+
+def load_corpus(corpus_dir, default_board):
+    pages = []
+    for dirpath, _, filenames in os.walk(corpus_dir):
+        rel_dir = os.path.relpath(dirpath, corpus_dir)
+        board_name = default_board if rel_dir == "." else rel_dir.split(os.sep)[0]
+        for name in sorted(filenames):
+            if not name.endswith(".html"):
+                continue
+            with open(os.path.join(dirpath, name), "rb") as infile:
+                body = infile.read()
+            url = URL_FORMAT.format(board_name=board_name, name=name)
+            if name.startswith("index"):
+                pages.append(("index", url, body))
+            else:
+                pages.append((size_class(body), url, body))
+    return pages
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def summarize(latencies):
+    total = sum(latencies)
+    return {
+        "count": len(latencies),
+        "per_sec": len(latencies) / total if total else None,
+        "p50_ms": percentile(latencies, 0.5) * 1000 if latencies else None,
+        "p99_ms": percentile(latencies, 0.99) * 1000 if latencies else None,
+    }
+
+
+def run(pages, repeat):
+    spider = PostsSpider.from_crawler(get_crawler(PostsSpider))
+    latencies = {}
+    for _ in range(repeat):
+        for kind, url, body in pages:
+            response = HtmlResponse(url, body=body, encoding="utf-8")
+            if kind == "index":
+                callback = spider.parse_index
+            else:
+                callback = spider.parse_post
+
+            start = time.perf_counter()
+            for _item in callback(response):
+                pass
+            latencies.setdefault(kind, []).append(time.perf_counter() - start)
+
+    post_latencies = [
+        latency
+        for kind, values in latencies.items()
+        if kind != "index"
+        for latency in values
+    ]
+    results = {kind: summarize(values) for kind, values in latencies.items()}
+    results["posts"] = summarize(post_latencies)
+    return results
+
+
+def print_results(results, baseline=None):
+    print(
+        "{:>8} {:>8} {:>10} {:>9} {:>9}".format(
+            "", "count", "per sec", "p50 ms", "p99 ms"
+        )
+    )
+    for kind in ["index", "small", "medium", "huge", "posts"]:
+        stats = results["stages"].get(kind)
+        if stats is None:
+            continue
+        line = "{:>8} {:>8} {:>10.1f} {:>9.2f} {:>9.2f}".format(
+            kind, stats["count"], stats["per_sec"], stats["p50_ms"], stats["p99_ms"]
+        )
+        if baseline is not None and kind in baseline["stages"]:
+            line += "  ({:+.1%} per sec)".format(
+                stats["per_sec"] / baseline["stages"][kind]["per_sec"] - 1
+            )
+        print(line)
+    print("peak RSS: {:.1f} MiB".format(results["peak_rss_kb"] / 1024))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("corpus_dir")
+    parser.add_argument("--board", default="Test", help="Board of flat corpora.")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", help="Results JSON file to compare against.")
+    args = parser.parse_args()
+
+    pages = load_corpus(args.corpus_dir, args.board)
+    if not pages:
+        parser.error("no .html files found in {}".format(args.corpus_dir))
+
+    # warm up lxml and the spider before timing
+    run(pages[:1], 1)
+    results = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "scrapy": scrapy.__version__,
+        "pages": len(pages),
+        "repeat": args.repeat,
+        "stages": run(pages, args.repeat),
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf8") as infile:
+            baseline = json.load(infile)
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as outfile:
+            json.dump(results, outfile, indent=2)
+        print("results written to {}".format(args.output), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Check that loading the project stays within an import-time budget.
+
+Each run starts a fresh interpreter, imports Scrapy, then the project
+modules a crawl loads, and sets up the files pipeline without a files
+store. The budget is relative to Scrapy's own import time, so that it holds
+on slower machines: the check fails if the median project time over the
+runs is more than `--max-ratio` of the median Scrapy time, or if the
+project loads B2 or encryption dependencies, e.g.
+
+    python bin/check_startup.py --max-ratio 0.15 --runs 9
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+PROJECT_MODULES = (
+    "ptt_crawler.settings",
+    "ptt_crawler.spiders.posts",
+    "ptt_crawler.middlewares",
+    "ptt_crawler.pipelines",
+    "ptt_crawler.frontier",
+    "ptt_crawler.httpcache",
+    "ptt_crawler.profiling",
+)
+
+# Only needed when FILES_STORE is a b2:// store or FILES_ENCRYPTION_KEY is set.
+LAZY_MODULES = ("boto3", "botocore", "ptt_crawler.crypto")
+
+CHILD_SCRIPT = """
+import importlib
+import json
+import sys
+import time
+
+start = time.perf_counter()
+import scrapy.crawler
+from scrapy.exceptions import NotConfigured
+from scrapy.settings import Settings
+
+baseline = time.perf_counter() - start
+start = time.perf_counter()
+for name in {modules!r}:
+    importlib.import_module(name)
+from ptt_crawler.pipelines import EncryptedFilesPipeline
+
+settings = Settings()
+settings.setmodule("ptt_crawler.settings")
+settings.set("FILES_STORE", "")
+try:
+    EncryptedFilesPipeline.from_settings(settings)
+except NotConfigured:
+    pass
+elapsed = time.perf_counter() - start
+print(
+    json.dumps(
+        {{"baseline": baseline, "elapsed": elapsed, "modules": sorted(sys.modules)}}
+    )
+)
+"""
+
+
+def measure():
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD_SCRIPT.format(modules=PROJECT_MODULES)],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--max-ratio",
+        type=float,
+        default=0.15,
+        help="Allowed import time of the project modules, relative to Scrapy's.",
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=7,
+        help="Interpreters to start; the medians of the runs are compared.",
+    )
+    args = parser.parse_args()
+
+    runs = [measure() for _ in range(args.runs)]
+    baseline = statistics.median(run["baseline"] for run in runs) * 1000
+    elapsed = statistics.median(run["elapsed"] for run in runs) * 1000
+    budget = baseline * args.max_ratio
+    loaded = [
+        lazy
+        for lazy in LAZY_MODULES
+        if any(
+            name == lazy or name.startswith(lazy + ".") for name in runs[0]["modules"]
+        )
+    ]
+
+    print(
+        "project import: {:.1f} ms (budget {:.1f} ms, {:.0%} of Scrapy's "
+        "{:.1f} ms)".format(elapsed, budget, args.max_ratio, baseline)
+    )
+    failed = False
+    if elapsed > budget:
+        print("FAIL: project import is over budget")
+        failed = True
+    if loaded:
+        print("FAIL: loaded at startup: {}".format(", ".join(loaded)))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,171 @@
+"""Compact item exports into per-board archives with random access by post.
+
+    python bin/compact_items.py compact b2://bucket/items/posts --output archive
+    python bin/compact_items.py get https://www.ptt.cc/bbs/Stock/M.1700000000.A.1F3.html
+
+Later exports replace earlier versions of a post and refresh deltas are
+applied to it, so each board archive holds the latest version of every post.
+"""
+
+import argparse
+import json
+import logging
+import os
+from collections import defaultdict
+
+from ptt_crawler.archive import DATA_SUFFIX
+from ptt_crawler.archive import DEFAULT_BLOCK_SIZE
+from ptt_crawler.archive import INDEX_SUFFIX
+from ptt_crawler.archive import B2ArchiveStore
+from ptt_crawler.archive import BoardArchive
+from ptt_crawler.archive import LocalArchiveStore
+from ptt_crawler.archive import compact_board
+from ptt_crawler.b2 import get_b2_client
+from ptt_crawler.b2 import get_transfer_config
+from ptt_crawler.utils import get_shub_project_settings
+from ptt_crawler.utils import list_item_sources
+from ptt_crawler.utils import parse_post_url
+from ptt_crawler.utils import read_item_source
+from ptt_crawler.utils import split_bucket_prefix
+
+# Sources already compacted into the archive, one per line.
+SOURCES_FILE = "sources.txt"
+
+
+def load_sources(directory):
+    path = os.path.join(directory, SOURCES_FILE)
+    if not os.path.exists(path):
+        return set()
+    with open(path, encoding="utf8") as infile:
+        return set(infile.read().splitlines())
+
+
+def compact(args):
+    b2_args = (args.b2_endpoint, args.b2_key_id, args.b2_application_key)
+    compacted = load_sources(args.output)
+    sources = []
+    updates = defaultdict(dict)
+    skipped = 0
+    for source in list_item_sources(args.sources, b2_args):
+        if source in compacted:
+            logging.warning("{} already compacted, skipped".format(source))
+            continue
+        for item in read_item_source(source, b2_args):
+            board, article_id = parse_post_url(item.get("url") or "")
+            if article_id is None:
+                skipped += 1
+                continue
+            if "push_offset" in item:
+                updates[board].setdefault(article_id, (None, []))[1].append(item)
+            else:
+                updates[board][article_id] = (item, [])
+        sources.append(source)
+        logging.warning("{} read".format(source))
+    if skipped:
+        logging.warning("{} items without a post URL skipped".format(skipped))
+
+    for board in sorted(updates):
+        count, dropped = compact_board(
+            args.output, board, updates[board], block_size=args.block_size
+        )
+        logging.warning(
+            "{}: {} posts, {} updated, {} deltas without a post dropped".format(
+                board, count, len(updates[board]), dropped
+            )
+        )
+    with open(os.path.join(args.output, SOURCES_FILE), "a", encoding="utf8") as outfile:
+        for source in sources:
+            outfile.write(source + "\n")
+
+    if args.upload:
+        b2 = get_b2_client(*b2_args)
+        bucket_name, *prefix = split_bucket_prefix(args.upload)
+        transfer_config = get_transfer_config(get_shub_project_settings())
+        for board in sorted(updates):
+            # the index goes last, so that it never points past the data
+            for name in (board + DATA_SUFFIX, board + INDEX_SUFFIX):
+                key = os.path.join(prefix[0], name) if prefix else name
+                b2.upload_file(
+                    os.path.join(args.output, name),
+                    bucket_name,
+                    key,
+                    Config=transfer_config,
+                )
+            logging.warning("{} uploaded to {}".format(board, args.upload))
+
+
+def get(args):
+    if args.archive.startswith("b2://"):
+        bucket_name, *prefix = split_bucket_prefix(args.archive)
+        client = get_b2_client(
+            args.b2_endpoint, args.b2_key_id, args.b2_application_key
+        )
+        store = B2ArchiveStore(client, bucket_name, prefix[0] if prefix else "")
+    else:
+        store = LocalArchiveStore(args.archive)
+
+    archives = {}
+    for url in args.urls:
+        board, article_id = parse_post_url(url)
+        if article_id is None:
+            raise SystemExit("{} is not a post URL".format(url))
+        if board not in archives:
+            archives[board] = BoardArchive(store, board)
+        post = archives[board].get(article_id)
+        if post is None:
+            logging.warning("{} not found".format(url))
+        else:
+            print(json.dumps(post, ensure_ascii=False))
+
+
+def parse_args():
+    settings = get_shub_project_settings()
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--b2-endpoint", default=settings.get("B2_ENDPOINT"))
+    parser.add_argument("--b2-key-id", default=settings.get("B2_KEY_ID"))
+    parser.add_argument(
+        "--b2-application-key", default=settings.get("B2_APPLICATION_KEY")
+    )
+    subparsers = parser.add_subparsers(required=True)
+
+    compact_parser = subparsers.add_parser(
+        "compact", help="Merge .jl or .jl.gz exports into the board archives."
+    )
+    compact_parser.add_argument(
+        "sources", nargs="+", help="Files, directories or b2://bucket/prefix."
+    )
+    compact_parser.add_argument(
+        "--output", required=True, help="Local directory of the archives."
+    )
+    compact_parser.add_argument(
+        "--upload", help="Copy updated archives to b2://bucket/prefix."
+    )
+    compact_parser.add_argument(
+        "--block-size",
+        type=int,
+        default=DEFAULT_BLOCK_SIZE,
+        help="Uncompressed bytes per block.",
+    )
+    compact_parser.set_defaults(func=compact)
+
+    get_parser = subparsers.add_parser("get", help="Print archived posts as JSON.")
+    get_parser.add_argument("urls", nargs="+", metavar="url")
+    get_parser.add_argument(
+        "--archive",
+        default=settings.get("ITEMS_ARCHIVE"),
+        help="Local directory or b2://bucket/prefix of the archives.",
+    )
+    get_parser.set_defaults(func=get)
+
+    args = parser.parse_args()
+    if args.func is get:
+        assert args.archive
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.func(args)
@@ -1,27 +1,137 @@
 import argparse
 import getpass
+import logging
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 
-from cryptography.fernet import Fernet
+from ptt_crawler.b2 import get_b2_client
+from ptt_crawler.crypto import StreamCipher
+from ptt_crawler.utils import get_shub_project_settings
+from ptt_crawler.utils import split_bucket_prefix
+
+_cipher = None
+_b2 = None
+
+
+def init_worker(key, b2_args):
+    global _cipher, _b2
+    _cipher = StreamCipher(key)
+    if b2_args is not None:
+        _b2 = get_b2_client(*b2_args)
+
+
+def output_path(output_dir, rel_path):
+    base, ext = os.path.splitext(rel_path)
+    return os.path.join(output_dir, f"{base}.decrypted{ext}")
+
+
+def list_local(input_dir):
+    for dirpath, _, filenames in os.walk(input_dir):
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            yield path, os.path.relpath(path, input_dir)
+
+
+def list_b2(b2, uri):
+    bucket_name, *prefix = split_bucket_prefix(uri)
+    prefix = prefix[0].rstrip("/") + "/" if prefix and prefix[0] else ""
+    paginator = b2.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            key = obj["Key"]
+            yield "b2://{}/{}".format(bucket_name, key), key[len(prefix) :]
+
+
+def decrypt_file(task):
+    source, out_path = task
+    tmp_path = out_path + ".part"
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    try:
+        with open(tmp_path, "wb") as outfile:
+            if source.startswith("b2://"):
+                bucket_name, key = split_bucket_prefix(source)
+                body = _b2.get_object(Bucket=bucket_name, Key=key)["Body"]
+                with body:
+                    _cipher.decrypt_stream(body, outfile)
+            else:
+                with open(source, "rb") as infile:
+                    _cipher.decrypt_stream(infile, outfile)
+        os.replace(tmp_path, out_path)
+    except Exception as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return source, 0, "{}: {}".format(type(e).__name__, e)
+    return source, os.path.getsize(out_path), None
 
 
 def main() -> None:
+    settings = get_shub_project_settings()
+
     parser = argparse.ArgumentParser()
-    parser.add_argument("input_dir")
+    parser.add_argument("input_dir", help="Local directory or b2://bucket/prefix.")
     parser.add_argument("output_dir")
+    parser.add_argument(
+        "--jobs", type=int, default=os.cpu_count(), help="Number of processes."
+    )
+    parser.add_argument("--b2-endpoint", default=settings.get("B2_ENDPOINT"))
+    parser.add_argument("--b2-key-id", default=settings.get("B2_KEY_ID"))
+    parser.add_argument(
+        "--b2-application-key", default=settings.get("B2_APPLICATION_KEY")
+    )
+    parser.add_argument("--progress-every", type=float, default=10.0)
     args = parser.parse_args()
 
     key = getpass.getpass("Enter your encryption key: ")
-    cipher = Fernet(key)
     os.makedirs(args.output_dir, exist_ok=True)
 
-    for name in os.listdir(args.input_dir):
-        base, ext = os.path.splitext(name)
-        out_name = f"{base}.decrypted{ext}"
-        with open(os.path.join(args.input_dir, name), "rb") as infile, open(
-            os.path.join(args.output_dir, out_name), "wb"
-        ) as outfile:
-            outfile.write(cipher.decrypt(infile.read()))
+    if args.input_dir.startswith("b2://"):
+        b2_args = (args.b2_endpoint, args.b2_key_id, args.b2_application_key)
+        sources = list_b2(get_b2_client(*b2_args), args.input_dir)
+    else:
+        b2_args = None
+        sources = list_local(args.input_dir)
+
+    tasks = []
+    skipped = 0
+    for source, rel_path in sources:
+        out_path = output_path(args.output_dir, rel_path)
+        if os.path.exists(out_path):
+            skipped += 1
+        else:
+            tasks.append((source, out_path))
+    logging.warning(
+        "{} files to decrypt, {} already decrypted".format(len(tasks), skipped)
+    )
+
+    start = last_report = time.monotonic()
+    done = failed = total_bytes = 0
+    with ProcessPoolExecutor(
+        max_workers=args.jobs, initializer=init_worker, initargs=(key, b2_args)
+    ) as executor:
+        for source, size, error in executor.map(decrypt_file, tasks, chunksize=8):
+            done += 1
+            total_bytes += size
+            if error is not None:
+                failed += 1
+                logging.error("failed to decrypt {}: {}".format(source, error))
+
+            now = time.monotonic()
+            if now - last_report >= args.progress_every or done == len(tasks):
+                last_report = now
+                elapsed = max(now - start, 1e-9)
+                logging.warning(
+                    "{}/{} files, {} failed, {:.1f} files/s, {:.1f} MB/s".format(
+                        done,
+                        len(tasks),
+                        failed,
+                        done / elapsed,
+                        total_bytes / elapsed / 1024 / 1024,
+                    )
+                )
+
+    if failed:
+        raise SystemExit("{} files failed".format(failed))
 
 
 if __name__ == "__main__":
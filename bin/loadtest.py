@@ -0,0 +1,498 @@
+"""Load test the whole crawl against local mocks of PTT, imgur and B2.
+
+Starts an HTTP server generating synthetic boards, with numbered index
+pages, posts with random push counts and image links, and a minimal S3
+compatible server standing in for B2. Then runs `scrapy crawl posts`
+against them once per concurrency level, e.g.
+
+    python bin/loadtest.py --boards 4 --pages 20 --concurrency 8,32,64
+
+Every --interval seconds it samples pages/sec and images/sec served,
+upload bytes/sec received and the RSS of the crawler, and prints a summary
+per concurrency level at the end. Extra settings are passed to the crawl
+with -s NAME=VALUE, as with scrapy itself.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIRST_TIMESTAMP = 1700000000
+MB = 1024 * 1024
+
+INDEX_PATH_RE = re.compile(r"^/bbs/(\w+)/index(\d*)\.html$")
+POST_PATH_RE = re.compile(r"^/bbs/(\w+)/M\.(\d+)\.A\.[0-9A-F]+\.html$")
+IMAGE_PATH_RE = re.compile(r"^/images/(\w+)/(\d+)-(\d+)\.jpg$")
+
+
+class Counters(object):
+    """Thread-safe counters of a mock server."""
+
+    def __init__(self, *names):
+        self._lock = threading.Lock()
+        self._values = dict.fromkeys(names, 0)
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self._values[name] += value
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class MockPttHandler(BaseHTTPRequestHandler):
+    """Serve synthetic boards, posts and images.
+
+    The server has `options` (the parsed arguments), `counters`, `payload`
+    (the bytes of an image) and `image_url`, the base URL of image links.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body, content_type="text/html; charset=utf-8", status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        counters = self.server.counters
+        m = INDEX_PATH_RE.match(path)
+        if m:
+            board, index = m.group(1), int(m.group(2) or self.server.options.pages)
+            if 1 <= index <= self.server.options.pages:
+                counters.inc("index_pages")
+                return self._send(self.index_page(board, index))
+        m = POST_PATH_RE.match(path)
+        if m:
+            counters.inc("posts")
+            return self._send(self.post_page(m.group(1), int(m.group(2))))
+        m = IMAGE_PATH_RE.match(path)
+        if m:
+            counters.inc("images")
+            counters.inc("image_bytes", len(self.server.payload))
+            # a distinct prefix per image, so that every checksum differs
+            prefix = hashlib.md5(path.encode("utf8")).digest()
+            body = prefix + self.server.payload[len(prefix) :]
+            return self._send(body, content_type="image/jpeg")
+        self._send(b"not found", status=404)
+
+    def index_page(self, board, index):
+        options = self.server.options
+        first = FIRST_TIMESTAMP + (index - 1) * options.posts_per_page
+        entries = "".join(
+            '<div class="r-ent"><div class="nrec"></div><div class="title">'
+            '<a href="/bbs/{board}/{article_id}.html">test {ts}</a></div>'
+            '<div class="meta"></div></div>'.format(
+                board=board, article_id=article_id(ts), ts=ts
+            )
+            for ts in range(first, first + options.posts_per_page)
+        )
+        previous = (
+            '<a class="btn wide" href="/bbs/{}/index{}.html">&lsaquo; 上頁</a>'.format(
+                board, index - 1
+            )
+            if index > 1
+            else ""
+        )
+        return (
+            '<html><body><div id="action-bar-container">'
+            '<div class="btn-group btn-group-paging">{}</div></div>'
+            '<div class="r-list-container action-bar-margin bbs-screen">{}</div>'
+            "</body></html>".format(previous, entries)
+        ).encode("utf8")
+
+    def post_page(self, board, ts):
+        options = self.server.options
+        rng = random.Random(ts)
+        pushes = "".join(
+            '<div class="push"><span class="hl push-tag">推 </span>'
+            '<span class="f3 hl push-userid">user{}</span>'
+            '<span class="f3 push-content">: comment {}</span>'
+            '<span class="push-ipdatetime"> 10.0.0.{} 10/18 12:{:02d}\n</span>'
+            "</div>".format(i % 50, i, i % 255, i % 60)
+            for i in range(rng.randint(options.min_pushes, options.max_pushes))
+        )
+        links = "".join(
+            '<a href="{0}" target="_blank" rel="nofollow">{0}</a>\n'.format(
+                "{}/images/{}/{}-{}.jpg".format(self.server.image_url, board, ts, i)
+            )
+            for i in range(options.images)
+        )
+        return (
+            '<html><head><meta property="og:title" content="[測試] load test {ts}">'
+            '</head><body><div id="main-content" class="bbs-screen bbs-content">'
+            '<div class="article-metaline"><span class="article-meta-tag">作者</span>'
+            '<span class="article-meta-value">loadtest (Load Test)</span></div>'
+            '<div class="article-metaline"><span class="article-meta-tag">標題</span>'
+            '<span class="article-meta-value">[測試] load test {ts}</span></div>'
+            '<div class="article-metaline"><span class="article-meta-tag">時間</span>'
+            '<span class="article-meta-value">{date}</span></div>'
+            "{content}\n{links}\n--\n"
+            '<span class="f2">※ 發信站: 批踢踢實業坊(ptt.cc), 來自: 10.0.0.1\n</span>'
+            "{pushes}</div></body></html>".format(
+                ts=ts,
+                date=time.strftime("%a %b %d %H:%M:%S %Y", time.gmtime(ts)),
+                content="內容 " * rng.randint(20, 500),
+                links=links,
+                pushes=pushes,
+            )
+        ).encode("utf8")
+
+
+class MockS3Handler(BaseHTTPRequestHandler):
+    """Just enough of S3 for B2FilesStore: HEAD, PUT and multipart uploads.
+
+    Uploaded bytes are counted and dropped; only their size, ETag and
+    metadata are kept in the server's `objects`.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = bytearray()
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                        pass
+                    return bytes(body)
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _body_size(self, body):
+        # aws-chunked bodies carry chunk headers and trailing checksums
+        decoded = self.headers.get("x-amz-decoded-content-length")
+        return int(decoded) if decoded is not None else len(body)
+
+    def _key(self):
+        return urlsplit(self.path).path
+
+    def _query(self):
+        return parse_qs(urlsplit(self.path).query, keep_blank_values=True)
+
+    def do_HEAD(self):
+        obj = self.server.objects.get(self._key())
+        if obj is None:
+            return self._send(404)
+        headers = {
+            "ETag": obj["etag"],
+            "Last-Modified": formatdate(obj["mtime"], usegmt=True),
+            "Content-Type": "binary/octet-stream",
+        }
+        for name, value in obj["meta"].items():
+            headers["x-amz-meta-" + name] = value
+        self.send_response(200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(obj["size"]))
+        self.end_headers()
+
+    def do_PUT(self):
+        body = self._read_body()
+        size = self._body_size(body)
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        self.server.counters.inc("uploads")
+        self.server.counters.inc("upload_bytes", size)
+        query = self._query()
+        if "uploadId" in query:
+            parts = self.server.uploads[query["uploadId"][0]]
+            parts[int(query["partNumber"][0])] = size
+        else:
+            self.server.objects[self._key()] = {
+                "size": size,
+                "etag": etag,
+                "mtime": time.time(),
+                "meta": {
+                    name[len("x-amz-meta-") :]: value
+                    for name, value in self.headers.items()
+                    if name.lower().startswith("x-amz-meta-")
+                },
+            }
+        self._send(200, headers={"ETag": etag})
+
+    def do_POST(self):
+        self._read_body()
+        query = self._query()
+        key = self._key()
+        bucket, _, name = key[1:].partition("/")
+        if "uploads" in query:
+            upload_id = uuid.uuid4().hex
+            self.server.uploads[upload_id] = {}
+            body = (
+                "<InitiateMultipartUploadResult><Bucket>{}</Bucket><Key>{}</Key>"
+                "<UploadId>{}</UploadId></InitiateMultipartUploadResult>"
+            ).format(bucket, name, upload_id)
+        elif "uploadId" in query:
+            parts = self.server.uploads.pop(query["uploadId"][0])
+            etag = '"{}-{}"'.format(uuid.uuid4().hex, len(parts))
+            self.server.objects[key] = {
+                "size": sum(parts.values()),
+                "etag": etag,
+                "mtime": time.time(),
+                "meta": {},
+            }
+            body = (
+                "<CompleteMultipartUploadResult><Bucket>{}</Bucket><Key>{}</Key>"
+                "<ETag>{}</ETag></CompleteMultipartUploadResult>"
+            ).format(bucket, name, etag)
+        else:
+            return self._send(501)
+        self._send(200, body.encode("utf8"), {"Content-Type": "application/xml"})
+
+    def do_DELETE(self):
+        self.server.uploads.pop(self._query().get("uploadId", [None])[0], None)
+        self._send(204)
+
+
+def article_id(ts):
+    return "M.{}.A.{:03X}".format(ts, ts % 4096)
+
+
+def start_server(handler, **attrs):
+    server = MockServer(("127.0.0.1", 0), handler)
+    for name, value in attrs.items():
+        setattr(server, name, value)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def read_rss(pid):
+    """Return the resident set size of a process in bytes, where /proc exists."""
+    try:
+        with open("/proc/{}/status".format(pid)) as infile:
+            for line in infile:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def run_crawl(concurrency, args, ptt, s3, encryption_key, log_file):
+    board_names = ",".join("LoadTest{}".format(i) for i in range(args.boards))
+    command = [
+        sys.executable,
+        "-m",
+        "scrapy",
+        "crawl",
+        "posts",
+        "-a",
+        "base_url=http://127.0.0.1:{}".format(ptt.server_port),
+        "-a",
+        "board_names=" + board_names,
+        "-a",
+        "max_pages={}".format(args.pages),
+    ]
+    settings = {
+        "CONCURRENT_REQUESTS": concurrency,
+        "CONCURRENT_REQUESTS_PER_DOMAIN": concurrency,
+        "ROBOTSTXT_OBEY": False,
+        "IMAGE_HOSTS": "localhost",
+        "FILES_STORE": "b2://loadtest/files",
+        "B2_ENDPOINT": "http://127.0.0.1:{}".format(s3.server_port),
+        "B2_KEY_ID": "loadtest",
+        "B2_APPLICATION_KEY": "loadtest",
+        "LOG_FILE": log_file,
+        "LOG_LEVEL": "INFO",
+    }
+    if encryption_key is not None:
+        settings["FILES_ENCRYPTION_KEY"] = encryption_key
+    for setting in args.set:
+        name, _, value = setting.partition("=")
+        settings[name] = value
+    for name, value in settings.items():
+        command.extend(("-s", "{}={}".format(name, value)))
+
+    s3.objects.clear()
+    start = time.time()
+    process = subprocess.Popen(command, cwd=PROJECT_DIR)
+    samples = []
+    last = dict(ptt.counters.snapshot(), **s3.counters.snapshot())
+    last_time = start
+    while True:
+        done = process.poll() is not None
+        if not done:
+            time.sleep(args.interval)
+        now = time.time()
+        counts = dict(ptt.counters.snapshot(), **s3.counters.snapshot())
+        elapsed = now - last_time
+        sample = {
+            "concurrency": concurrency,
+            "time": round(now - start, 3),
+            "pages_per_sec": (
+                counts["index_pages"]
+                + counts["posts"]
+                - last["index_pages"]
+                - last["posts"]
+            )
+            / elapsed,
+            "images_per_sec": (counts["images"] - last["images"]) / elapsed,
+            "upload_bytes_per_sec": (counts["upload_bytes"] - last["upload_bytes"])
+            / elapsed,
+            "rss": read_rss(process.pid) if not done else None,
+        }
+        samples.append(sample)
+        last, last_time = counts, now
+        if done:
+            break
+        print(
+            "  c={concurrency:<4} {time:7.1f}s {pages_per_sec:8.1f} pages/s "
+            "{images_per_sec:8.1f} images/s {upload:8.2f} MB/s upload "
+            "{rss_mb} MB RSS".format(
+                upload=sample["upload_bytes_per_sec"] / MB,
+                rss_mb="{:.0f}".format(sample["rss"] / MB) if sample["rss"] else "?",
+                **sample
+            )
+        )
+    return process.returncode, time.time() - start, samples
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--boards", type=int, default=2)
+    parser.add_argument("--pages", type=int, default=10, help="Index pages per board.")
+    parser.add_argument("--posts-per-page", type=int, default=20)
+    parser.add_argument("--min-pushes", type=int, default=0)
+    parser.add_argument("--max-pushes", type=int, default=100)
+    parser.add_argument("--images", type=int, default=2, help="Images per post.")
+    parser.add_argument("--image-size", type=int, default=200 * 1024, help="Bytes.")
+    parser.add_argument(
+        "--concurrency",
+        default="8,16,32",
+        help="Comma-separated CONCURRENT_REQUESTS levels to run.",
+    )
+    parser.add_argument("--interval", type=float, default=1.0)
+    parser.add_argument(
+        "--no-encryption", action="store_true", help="Upload images unencrypted."
+    )
+    parser.add_argument(
+        "-s",
+        dest="set",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="Extra setting of the crawl.",
+    )
+    parser.add_argument("--output", help="Write the samples as JSON lines here.")
+    parser.add_argument(
+        "--log-dir", default=".", help="Directory of the crawl log of each level."
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    ptt = start_server(
+        MockPttHandler,
+        options=args,
+        counters=Counters("index_pages", "posts", "images", "image_bytes"),
+        payload=os.urandom(max(args.image_size, 16)),
+    )
+    # images on another host name, so that they get a download slot of their
+    # own as they would on imgur
+    ptt.image_url = "http://localhost:{}".format(ptt.server_port)
+    s3 = start_server(
+        MockS3Handler,
+        counters=Counters("uploads", "upload_bytes"),
+        objects={},
+        uploads={},
+    )
+    encryption_key = None
+    if not args.no_encryption:
+        from cryptography.fernet import Fernet
+
+        encryption_key = Fernet.generate_key().decode("ascii")
+
+    os.makedirs(args.log_dir, exist_ok=True)
+    outfile = open(args.output, "w") if args.output else None
+    results = []
+    for concurrency in (int(c) for c in args.concurrency.split(",")):
+        print("concurrency {}".format(concurrency))
+        log_file = os.path.join(
+            os.path.abspath(args.log_dir), "loadtest-c{}.log".format(concurrency)
+        )
+        before = dict(ptt.counters.snapshot(), **s3.counters.snapshot())
+        returncode, elapsed, samples = run_crawl(
+            concurrency, args, ptt, s3, encryption_key, log_file
+        )
+        after = dict(ptt.counters.snapshot(), **s3.counters.snapshot())
+        totals = {name: after[name] - before[name] for name in after}
+        rss = [sample["rss"] for sample in samples if sample["rss"]]
+        results.append(
+            (concurrency, returncode, elapsed, totals, max(rss) if rss else None)
+        )
+        if outfile is not None:
+            for sample in samples:
+                outfile.write(json.dumps(sample) + "\n")
+    if outfile is not None:
+        outfile.close()
+
+    print(
+        "\n{:>11} {:>8} {:>9} {:>9} {:>11} {:>9} {:>6}".format(
+            "concurrency",
+            "secs",
+            "pages/s",
+            "images/s",
+            "upload MB/s",
+            "peak RSS",
+            "exit",
+        )
+    )
+    for concurrency, returncode, elapsed, totals, peak_rss in results:
+        print(
+            "{:>11} {:>8.1f} {:>9.1f} {:>9.1f} {:>11.2f} {:>9} {:>6}".format(
+                concurrency,
+                elapsed,
+                (totals["index_pages"] + totals["posts"]) / elapsed,
+                totals["images"] / elapsed,
+                totals["upload_bytes"] / elapsed / MB,
+                "{:.0f} MB".format(peak_rss / MB) if peak_rss else "?",
+                returncode,
+            )
+        )
+    if any(returncode for _, returncode, _, _, _ in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import argparse
+import logging
+
+from ptt_crawler.b2 import get_b2_client
+from ptt_crawler.fileindex import FilesIndex
+from ptt_crawler.fileindex import etag_checksum
+from ptt_crawler.utils import get_shub_project_settings
+from ptt_crawler.utils import split_bucket_prefix
+
+
+def main(b2_endpoint, b2_key_id, b2_application_key, files_store, index, batch_size):
+    bucket_name, *prefix = split_bucket_prefix(files_store)
+    client = get_b2_client(b2_endpoint, b2_key_id, b2_application_key)
+    files_index = FilesIndex(index)
+
+    rows = []
+    total = 0
+    paginator = client.get_paginator("list_objects_v2")
+    pages = paginator.paginate(Bucket=bucket_name, Prefix=prefix[0] if prefix else "")
+    for obj in (obj for page in pages for obj in page.get("Contents", [])):
+        # ETag is the MD5 of single-part uploads, which is what the
+        # pipeline records as checksum; multipart uploads get none.
+        rows.append(
+            (
+                obj["Key"],
+                obj["LastModified"].timestamp(),
+                etag_checksum(obj["ETag"]),
+                obj["Size"],
+            )
+        )
+        if len(rows) >= batch_size:
+            files_index.put_many(rows)
+            total += len(rows)
+            rows = []
+            logging.warning("{} files indexed".format(total))
+    files_index.put_many(rows)
+    total += len(rows)
+    logging.warning("{} files indexed into {}".format(total, index))
+    files_index.close()
+
+
+def parse_args():
+    settings = get_shub_project_settings()
+
+    parser = argparse.ArgumentParser(
+        description="Rebuild the local B2 files index from the bucket listing."
+    )
+    parser.add_argument("--b2-endpoint", default=settings.get("B2_ENDPOINT"))
+    parser.add_argument("--b2-key-id", default=settings.get("B2_KEY_ID"))
+    parser.add_argument(
+        "--b2-application-key", default=settings.get("B2_APPLICATION_KEY")
+    )
+    parser.add_argument("--files-store", default=settings.get("FILES_STORE"))
+    parser.add_argument("--index", default=settings.get("B2_FILES_INDEX"))
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    assert args.files_store.startswith("b2://")
+    assert args.index
+
+    return args
+
+
+if "__main__" == __name__:
+    main(**vars(parse_args()))
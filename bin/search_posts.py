@@ -0,0 +1,124 @@
+import argparse
+import logging
+import time
+from datetime import datetime
+
+from ptt_crawler.items import expand_comments
+from ptt_crawler.search import SearchIndex
+from ptt_crawler.utils import get_shub_project_settings
+from ptt_crawler.utils import list_item_sources
+from ptt_crawler.utils import read_item_source
+
+
+def index(args):
+    b2_args = (args.b2_endpoint, args.b2_key_id, args.b2_application_key)
+    search_index = SearchIndex(args.index)
+    for source in list_item_sources(args.sources, b2_args):
+        if search_index.has_source(source):
+            logging.warning("{} already indexed, skipped".format(source))
+            continue
+        count = 0
+        for item in read_item_source(source, b2_args):
+            if "push_offset" in item:
+                # refresh deltas hold new pushes only
+                continue
+            comments = expand_comments(item.get("comments") or [], ("content",))
+            search_index.add(
+                item["url"],
+                item.get("title"),
+                item.get("content"),
+                [comment["content"] for comment in comments],
+                date=item.get("date"),
+                score=item.get("score"),
+            )
+            count += 1
+            if count % args.batch_size == 0:
+                search_index.flush()
+        search_index.flush()
+        search_index.add_source(source)
+        logging.warning("{} posts indexed from {}".format(count, source))
+    logging.warning("{} posts in {}".format(len(search_index), args.index))
+    search_index.close()
+
+
+def query(args):
+    search_index = SearchIndex(args.index)
+    start = time.perf_counter()
+    results = search_index.search(
+        " ".join(args.keywords),
+        board=args.board,
+        since=args.since,
+        until=args.until,
+        min_score=args.min_score,
+        limit=args.limit,
+    )
+    elapsed = time.perf_counter() - start
+    for result in results:
+        date = datetime.fromtimestamp(result["date"]) if result["date"] else None
+        print(
+            "{}  {:<12} {:>4}  {}  {}".format(
+                date.strftime("%Y-%m-%d") if date else "?",
+                result["board"],
+                result["score"] if result["score"] is not None else "",
+                result["title"],
+                result["url"],
+            )
+        )
+    logging.warning("{} results in {:.1f} ms".format(len(results), elapsed * 1000))
+    search_index.close()
+
+
+def compact(args):
+    search_index = SearchIndex(args.index)
+    dropped = search_index.compact()
+    logging.warning("{} replaced posts dropped".format(dropped))
+    search_index.close()
+
+
+def parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%d")
+
+
+def parse_args():
+    settings = get_shub_project_settings()
+
+    parser = argparse.ArgumentParser(description="Full-text search over posts.")
+    parser.add_argument("--index", default=settings.get("SEARCH_INDEX_PATH"))
+    subparsers = parser.add_subparsers(required=True)
+
+    index_parser = subparsers.add_parser(
+        "index", help="Add exported .jl or .jl.gz items to the index."
+    )
+    index_parser.add_argument(
+        "sources", nargs="+", help="Files, directories or b2://bucket/prefix."
+    )
+    index_parser.add_argument("--batch-size", type=int, default=1000)
+    index_parser.add_argument("--b2-endpoint", default=settings.get("B2_ENDPOINT"))
+    index_parser.add_argument("--b2-key-id", default=settings.get("B2_KEY_ID"))
+    index_parser.add_argument(
+        "--b2-application-key", default=settings.get("B2_APPLICATION_KEY")
+    )
+    index_parser.set_defaults(func=index)
+
+    query_parser = subparsers.add_parser("query", help="Search the index.")
+    query_parser.add_argument("keywords", nargs="+")
+    query_parser.add_argument("--board")
+    query_parser.add_argument("--since", type=parse_date, help="YYYY-MM-DD")
+    query_parser.add_argument("--until", type=parse_date, help="YYYY-MM-DD")
+    query_parser.add_argument("--min-score", type=int)
+    query_parser.add_argument("--limit", type=int, default=20)
+    query_parser.set_defaults(func=query)
+
+    compact_parser = subparsers.add_parser(
+        "compact", help="Merge postings and drop replaced posts."
+    )
+    compact_parser.set_defaults(func=compact)
+
+    args = parser.parse_args()
+    assert args.index
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.func(args)
@@ -1,30 +1,43 @@
 import argparse
-import gzip
-import io
-import json
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import boto3
-from botocore.config import Config
+from botocore.exceptions import ClientError
 from scrapinghub import ScrapinghubClient
 
+from ptt_crawler.b2 import get_b2_client
+from ptt_crawler.b2 import get_transfer_config
 from ptt_crawler.utils import get_shub_project_settings
+from ptt_crawler.utils import GzipJsonLinesStream
 from ptt_crawler.utils import split_bucket_prefix
-from ptt_crawler.utils import upload_file
-
-
-def get_b2_resource(endpoint: str, key_id: str, application_key: str):
-    b2 = boto3.resource(
-        service_name="s3",
-        endpoint_url=endpoint,  # Backblaze endpoint
-        aws_access_key_id=key_id,  # Backblaze keyID
-        aws_secret_access_key=application_key,  # Backblaze applicationKey
-        config=Config(
-            signature_version="s3v4",
-        ),
-    )
-    return b2
+
+
+def object_exists(b2, bucket_name, file_name):
+    try:
+        b2.head_object(Bucket=bucket_name, Key=file_name)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+    return True
+
+
+def export_job(spider, key, b2, bucket_name, file_name, transfer_config, delete):
+    if object_exists(b2, bucket_name, file_name):
+        logging.warning("job {} already exported, skipped".format(key))
+    else:
+        job = spider.jobs.get(key)
+        if not job:
+            return
+        # items are gzipped as boto3 reads them, part by part
+        source = GzipJsonLinesStream(job.items.iter())
+        b2.upload_fileobj(source, bucket_name, file_name, Config=transfer_config)
+        logging.warning("job {} exported to {}".format(key, file_name))
+
+    if delete:
+        spider.jobs.get(key).delete()
+        logging.warning("job {} deleted".format(key))
 
 
 def main(
@@ -36,42 +49,53 @@ def main(
     b2_application_key,
     b2_path,
     delete,
+    workers,
 ):
+    settings = get_shub_project_settings()
     bucket_name, root = split_bucket_prefix(b2_path)
-    bucket = None
+    b2 = get_b2_client(
+        b2_endpoint,
+        b2_key_id,
+        b2_application_key,
+        max_pool_connections=settings.getint("B2_MAX_POOL_CONNECTIONS", 20),
+    )
+    transfer_config = get_transfer_config(settings)
 
     client = ScrapinghubClient(api_key)
     project = client.get_project(project_id)
-    for name in spider_name:
-        spider = project.spiders.get(name)
-        job_list = spider.jobs.list(state="finished")
-        keys = []
-        for job in job_list:
-            if "items" in job and job["items"] > 0:
-                keys.append(job["key"])
-
-        if keys:
-            if bucket is None:
-                b2 = get_b2_resource(b2_endpoint, b2_key_id, b2_application_key)
-                bucket = b2.Bucket(bucket_name)
-            for key in keys:
-                job = spider.jobs.get(key)
-                if job:
-                    out = io.BytesIO()
-
-                    with gzip.GzipFile(fileobj=out, mode="w") as outfile:
-                        for item in job.items.iter():
-                            line = json.dumps(item) + "\n"
-                            outfile.write(line.encode("utf8"))
-                    content = out.getvalue()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for name in spider_name:
+            spider = project.spiders.get(name)
+            job_list = spider.jobs.list(state="finished")
+            for job in job_list:
+                if "items" in job and job["items"] > 0:
+                    key = job["key"]
                     file_name = os.path.join(
                         root, name, key.replace("/", "-") + ".jl.gz"
                     )
-                    upload_file(bucket, file_name, content)
+                    future = executor.submit(
+                        export_job,
+                        spider,
+                        key,
+                        b2,
+                        bucket_name,
+                        file_name,
+                        transfer_config,
+                        delete,
+                    )
+                    futures[future] = key
 
-                    if delete:
-                        job.delete()
-                        logging.warning("job {} deleted".format(key))
+        failed = 0
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                failed += 1
+                logging.exception("failed to export job {}".format(futures[future]))
+
+    if failed:
+        raise SystemExit("{} of {} jobs failed".format(failed, len(futures)))
 
 
 def parse_args():
@@ -90,6 +114,9 @@ def parse_args():
     )
     parser.add_argument("--b2-path", default=settings.get("ITEMS_STORE"))
     parser.add_argument("--delete", action="store_true")
+    parser.add_argument(
+        "--workers", type=int, default=4, help="Number of jobs exported in parallel."
+    )
     parser.add_argument("spider_name", nargs="+", help="Spider name to get info from.")
     args = parser.parse_args()
 
@@ -0,0 +1,267 @@
+import bisect
+import json
+import os
+import struct
+import zlib
+
+from ptt_crawler.items import COMMENT_FIELDS
+from ptt_crawler.items import LEGACY_COMMENT_FIELDS
+from ptt_crawler.items import expand_comments
+from ptt_crawler.utils import article_id_key
+from ptt_crawler.utils import parse_post_url
+
+# A board archive is a pair of files:
+#
+#   <board>.jl.gz  JSON lines of posts sorted by article ID, in blocks that
+#                  are gzip members of their own, so that any block can be
+#                  decompressed alone and the whole file is still gzip.
+#   <board>.idx    INDEX_HEADER, then one INDEX_RECORD per post sorted by
+#                  article ID: its key (see article_id_key), the offset and
+#                  size of its block and its line number within the block.
+DATA_SUFFIX = ".jl.gz"
+INDEX_SUFFIX = ".idx"
+INDEX_MAGIC = b"PTTARIDX"
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct(">8sII")
+INDEX_RECORD = struct.Struct(">QIQII")
+DEFAULT_BLOCK_SIZE = 64 * 1024
+
+
+def apply_delta(item, delta):
+    """Apply the pushes of a PostDeltaItem to the exported post `item`."""
+    offset = delta["push_offset"]
+    comments = item.get("comments") or []
+    if isinstance(comments, list):
+        new = expand_comments(delta["comments"], LEGACY_COMMENT_FIELDS)
+        item["comments"] = comments[:offset] + new
+    else:
+        size = len(delta["comments"]["score"])
+        item["comments"] = {
+            field: comments.get(field, [None] * offset)[:offset]
+            + delta["comments"].get(field, [None] * size)
+            for field in COMMENT_FIELDS
+        }
+    item["score"] = delta["score"]
+    return item
+
+
+class LocalArchiveStore(object):
+    """Board archives in a local directory."""
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def read(self, name, offset=0, size=None):
+        with open(self.path(name), "rb") as infile:
+            infile.seek(offset)
+            return infile.read() if size is None else infile.read(size)
+
+
+class B2ArchiveStore(object):
+    """Board archives under a prefix of a B2 (or any S3 compatible) bucket."""
+
+    def __init__(self, client, bucket: str, prefix: str = "") -> None:
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def key(self, name):
+        return "{}/{}".format(self.prefix, name) if self.prefix else name
+
+    def exists(self, name):
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        return True
+
+    def read(self, name, offset=0, size=None):
+        kwargs = {}
+        if offset or size is not None:
+            end = "" if size is None else offset + size - 1
+            kwargs["Range"] = "bytes={}-{}".format(offset, end)
+        response = self.client.get_object(
+            Bucket=self.bucket, Key=self.key(name), **kwargs
+        )
+        return response["Body"].read()
+
+
+class BoardArchive(object):
+    """Random access to the posts of one board archive in `store`.
+
+    The index is read once; each post then takes a single ranged read of
+    its block.
+    """
+
+    def __init__(self, store, board: str) -> None:
+        self.store = store
+        self.board = board
+        self.data_name = board + DATA_SUFFIX
+        index = store.read(board + INDEX_SUFFIX)
+        magic, version, count = INDEX_HEADER.unpack_from(index)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError("{} is not an archive index".format(board + INDEX_SUFFIX))
+        self._index = memoryview(index)[INDEX_HEADER.size :]
+        self._count = count
+        self._keys = _IndexKeys(self)
+
+    def __len__(self):
+        return self._count
+
+    def _record(self, i):
+        return INDEX_RECORD.unpack_from(self._index, i * INDEX_RECORD.size)
+
+    def _read_block(self, offset, size):
+        return zlib.decompress(self.store.read(self.data_name, offset, size), 31)
+
+    def get(self, article_id):
+        """Return the post with `article_id`, or None."""
+        key = article_id_key(article_id)
+        i = bisect.bisect_left(self._keys, key)
+        if i == self._count or self._keys[i] != key:
+            return None
+        _, _, offset, size, line = self._record(i)
+        lines = self._read_block(offset, size).split(b"\n")
+        return json.loads(lines[line])
+
+    def __iter__(self):
+        """Iterate over the posts in article ID order, a block at a time."""
+        previous = None
+        for i in range(self._count):
+            _, _, offset, size, _ = self._record(i)
+            if offset == previous:
+                continue
+            previous = offset
+            for line in self._read_block(offset, size).splitlines():
+                yield json.loads(line)
+
+
+class _IndexKeys(object):
+    """Sequence of the article ID keys of an index, for bisect."""
+
+    def __init__(self, archive):
+        self.archive = archive
+
+    def __len__(self):
+        return len(self.archive)
+
+    def __getitem__(self, i):
+        return self.archive._record(i)[:2]
+
+
+class BoardArchiveWriter(object):
+    """Write a board archive from posts added in article ID order.
+
+    Files are written next to their final paths and renamed on `close`, so
+    readers never see a partial archive.
+    """
+
+    def __init__(
+        self, directory: str, board: str, block_size: int = DEFAULT_BLOCK_SIZE
+    ) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.data_path = os.path.join(directory, board + DATA_SUFFIX)
+        self.index_path = os.path.join(directory, board + INDEX_SUFFIX)
+        self.block_size = block_size
+        self._data = open(self.data_path + ".tmp", "wb")
+        self._records = []
+        self._block = []
+        self._block_keys = []
+        self._block_bytes = 0
+        self._last_key = None
+
+    def add(self, article_id, item):
+        key = article_id_key(article_id)
+        if self._last_key is not None and key <= self._last_key:
+            raise ValueError("{} added out of order".format(article_id))
+        self._last_key = key
+        line = json.dumps(item).encode("utf8")
+        self._block.append(line)
+        self._block_keys.append(key)
+        self._block_bytes += len(line) + 1
+        if self._block_bytes >= self.block_size:
+            self._flush_block()
+
+    def _flush_block(self):
+        if not self._block:
+            return
+        offset = self._data.tell()
+        compressor = zlib.compressobj(wbits=31)
+        data = compressor.compress(b"\n".join(self._block) + b"\n")
+        data += compressor.flush()
+        self._data.write(data)
+        for line, (timestamp, suffix) in enumerate(self._block_keys):
+            self._records.append((timestamp, suffix, offset, len(data), line))
+        self._block = []
+        self._block_keys = []
+        self._block_bytes = 0
+
+    def __len__(self):
+        return len(self._records) + len(self._block)
+
+    def close(self):
+        self._flush_block()
+        self._data.close()
+        with open(self.index_path + ".tmp", "wb") as outfile:
+            outfile.write(
+                INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(self._records))
+            )
+            for record in self._records:
+                outfile.write(INDEX_RECORD.pack(*record))
+        os.replace(self.data_path + ".tmp", self.data_path)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+
+def compact_board(directory, board, updates, block_size=DEFAULT_BLOCK_SIZE):
+    """Merge `updates` into the archive of `board` in `directory`.
+
+    `updates` maps article IDs to (item, deltas): the latest exported post,
+    or None to update the archived one, and the refresh deltas to apply to
+    it in order. Returns the number of posts written and of deltas dropped
+    because their post was not found.
+    """
+    store = LocalArchiveStore(directory)
+    archived = iter(())
+    if store.exists(board + INDEX_SUFFIX):
+        archived = (
+            (parse_post_url(item["url"])[1], item)
+            for item in BoardArchive(store, board)
+        )
+    new = iter(sorted(updates, key=article_id_key))
+
+    writer = BoardArchiveWriter(directory, board, block_size=block_size)
+    dropped = 0
+    old_id, old_item = next(archived, (None, None))
+    new_id = next(new, None)
+    while old_id is not None or new_id is not None:
+        if new_id is None or (
+            old_id is not None and article_id_key(old_id) < article_id_key(new_id)
+        ):
+            writer.add(old_id, old_item)
+            old_id, old_item = next(archived, (None, None))
+            continue
+
+        item, deltas = updates[new_id]
+        if old_id is not None and article_id_key(old_id) == article_id_key(new_id):
+            if item is None:
+                item = old_item
+            old_id, old_item = next(archived, (None, None))
+        if item is None:
+            dropped += len(deltas)
+        else:
+            for delta in deltas:
+                item = apply_delta(item, delta)
+            writer.add(new_id, item)
+        new_id = next(new, None)
+    writer.close()
+    return len(writer), dropped
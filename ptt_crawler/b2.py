@@ -0,0 +1,50 @@
+import threading
+
+MB = 1024 * 1024
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_b2_client(
+    endpoint: str,
+    key_id: str,
+    application_key: str,
+    max_pool_connections: int = 20,
+):
+    """Return the S3 client shared by everything talking to one B2 account.
+
+    Unlike boto3 resources, low-level clients are thread-safe, so a single
+    client and its connection pool serve every upload thread.
+    """
+    # boto3 takes a noticeable part of the startup time; only load it for
+    # runs that talk to B2.
+    import boto3
+    from botocore.config import Config
+
+    key = (endpoint, key_id, application_key, max_pool_connections)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = boto3.session.Session().client(
+                service_name="s3",
+                endpoint_url=endpoint,  # Backblaze endpoint
+                aws_access_key_id=key_id,  # Backblaze keyID
+                aws_secret_access_key=application_key,  # Backblaze applicationKey
+                config=Config(
+                    signature_version="s3v4",
+                    max_pool_connections=max_pool_connections,
+                ),
+            )
+            _clients[key] = client
+    return client
+
+
+def get_transfer_config(settings):
+    from boto3.s3.transfer import TransferConfig
+
+    return TransferConfig(
+        multipart_threshold=settings.getint("B2_MULTIPART_THRESHOLD", 16 * MB),
+        multipart_chunksize=settings.getint("B2_MULTIPART_CHUNKSIZE", 16 * MB),
+        max_concurrency=settings.getint("B2_MAX_CONCURRENCY", 4),
+    )
@@ -0,0 +1,116 @@
+import base64
+import hashlib
+import os
+import struct
+
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+# Stream format: MAGIC, version, chunk size and nonce prefix, followed by
+# AES-GCM encrypted chunks of `chunk size` plaintext bytes each. The header
+# and a final-chunk flag are authenticated with every chunk, so a truncated
+# or reordered file fails to decrypt.
+MAGIC = b"PTTENC"
+VERSION = 1
+HEADER = struct.Struct(">6sBI8s")
+TAG_SIZE = 16
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+def _derive_key(key):
+    """Derive the AES key of the stream format from a Fernet key."""
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b"ptt-crawler stream v1",
+    ).derive(base64.urlsafe_b64decode(key))
+
+
+def _nonce(prefix, counter):
+    return prefix + struct.pack(">I", counter)
+
+
+def _aad(header, final):
+    return header + (b"\x01" if final else b"\x00")
+
+
+def _read_exactly(infile, size):
+    data = infile.read(size)
+    while data and len(data) < size:
+        more = infile.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+class StreamCipher(object):
+    """Chunked authenticated encryption with bounded memory.
+
+    `key` is the same urlsafe base64 key used by Fernet, so files written by
+    earlier versions can still be read with `decrypt_stream`.
+    """
+
+    def __init__(self, key, chunk_size: int = DEFAULT_CHUNK_SIZE) -> None:
+        self.key = key
+        self.chunk_size = chunk_size
+        self._aesgcm = AESGCM(_derive_key(key))
+
+    def encrypt_stream(self, infile, outfile) -> str:
+        """Encrypt `infile` into `outfile` and return the MD5 of the output."""
+        checksum = hashlib.md5()
+
+        def write(data):
+            checksum.update(data)
+            outfile.write(data)
+
+        header = HEADER.pack(MAGIC, VERSION, self.chunk_size, os.urandom(8))
+        prefix = header[-8:]
+        write(header)
+
+        counter = 0
+        chunk = _read_exactly(infile, self.chunk_size)
+        while True:
+            next_chunk = _read_exactly(infile, self.chunk_size)
+            final = not next_chunk
+            write(
+                self._aesgcm.encrypt(
+                    _nonce(prefix, counter), chunk, _aad(header, final)
+                )
+            )
+            if final:
+                break
+            chunk = next_chunk
+            counter += 1
+        return checksum.hexdigest()
+
+    def decrypt_stream(self, infile, outfile) -> None:
+        """Decrypt `infile` into `outfile`, accepting old Fernet tokens too."""
+        header = _read_exactly(infile, HEADER.size)
+        if not header.startswith(MAGIC):
+            token = header + infile.read()
+            outfile.write(Fernet(self.key).decrypt(token))
+            return
+
+        _, version, chunk_size, prefix = HEADER.unpack(header)
+        if version != VERSION:
+            raise ValueError("unsupported stream version {}".format(version))
+
+        counter = 0
+        size = chunk_size + TAG_SIZE
+        chunk = _read_exactly(infile, size)
+        while True:
+            next_chunk = _read_exactly(infile, size)
+            final = not next_chunk
+            outfile.write(
+                self._aesgcm.decrypt(
+                    _nonce(prefix, counter), chunk, _aad(header, final)
+                )
+            )
+            if final:
+                break
+            chunk = next_chunk
+            counter += 1
@@ -0,0 +1,107 @@
+import sys
+
+from lxml import etree
+
+from ptt_crawler.items import new_comments
+
+PUSH_SCORES = {"推": 1, "噓": -1}
+
+
+def _classes(element):
+    return (element.get("class") or "").split()
+
+
+def _push_score(push_tag):
+    for tag, score in PUSH_SCORES.items():
+        if tag in push_tag:
+            return score
+    return 0
+
+
+def _parse_push(element):
+    push = {}
+    for span in element:
+        for cls in _classes(span):
+            if cls.startswith("push-"):
+                push[cls] = span.text or ""
+    return push
+
+
+def _split_ipdatetime(ipdatetime):
+    """Split " 1.2.3.4 10/18 12:00" into its IP, which old pushes lack, and time."""
+    parts = ipdatetime.split()
+    if len(parts) >= 3:
+        return parts[0], " ".join(parts[1:3])
+    return None, " ".join(parts)
+
+
+def extract_post(root):
+    """Extract the fields of a post page by walking its tree once.
+
+    `root` is the parsed lxml document, e.g. `response.selector.root`. Returns
+    a dict with the title, metaline fields, body text, comments and the link
+    targets found in `#main-content`.
+    """
+    title = None
+    head = root.find("head")
+    if head is not None:
+        for element in head:
+            if element.tag == "meta" and element.get("property") == "og:title":
+                title = element.get("content")
+                break
+
+    main_content = root.get_element_by_id("main-content")
+    metalines = {}
+    body = [main_content.text or ""]
+    comments = new_comments()
+    links = []
+    for element in main_content:
+        if not isinstance(element.tag, str):
+            # comments and processing instructions
+            body.append(element.tail or "")
+            continue
+        classes = _classes(element)
+        if element.tag == "div" and classes == ["article-metaline"]:
+            if len(element) >= 2:
+                metalines[element[0].text] = element[1].text
+        elif element.tag == "div" and classes == ["push"]:
+            push = _parse_push(element)
+            ip, time = _split_ipdatetime(push.get("push-ipdatetime", ""))
+            comments["user"].append(sys.intern(push["push-userid"]))
+            comments["content"].append(push["push-content"])
+            comments["score"].append(_push_score(push["push-tag"]))
+            comments["ip"].append(ip)
+            comments["time"].append(time)
+            links.extend(a.get("href") for a in element.iter("a"))
+        elif "article-metaline-right" not in classes:
+            body.append(element.text_content())
+            links.extend(a.get("href") for a in element.iter("a"))
+        body.append(element.tail or "")
+
+    return {
+        "title": title,
+        "metalines": metalines,
+        "content": "".join(body).strip(),
+        "comments": comments,
+        "links": [href for href in links if href],
+    }
+
+
+def html2text_content(root):
+    """Return #main-content converted to markdown by html2text.
+
+    This is the `content` exported before extract_post, with the metalines
+    and pushes included and lines re-wrapped.
+    """
+    import html2text
+
+    converter = html2text.HTML2Text()
+    converter.ignore_links = True
+    return converter.handle(
+        etree.tostring(
+            root.get_element_by_id("main-content"),
+            method="html",
+            encoding="unicode",
+            with_tail=False,
+        )
+    )
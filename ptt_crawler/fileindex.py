@@ -0,0 +1,63 @@
+import logging
+import os
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+
+def etag_checksum(etag):
+    """Return the MD5 in an S3 ETag, or None for a multipart upload's ETag.
+
+    The ETag of a multipart upload is a hash of its parts' MD5s followed by
+    "-<number of parts>", not the MD5 of the file.
+    """
+    etag = etag.strip('"')
+    return None if "-" in etag else etag
+
+
+class FilesIndex(object):
+    """Local SQLite index of the files uploaded to a store, keyed by object key."""
+
+    def __init__(self, path: str) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "key TEXT PRIMARY KEY, "
+            "last_modified REAL NOT NULL, "
+            "checksum TEXT, "
+            "size INTEGER)"
+        )
+
+    def get(self, key):
+        row = self.conn.execute(
+            "SELECT last_modified, checksum, size FROM files WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        last_modified, checksum, size = row
+        return {"last_modified": last_modified, "checksum": checksum, "size": size}
+
+    def put(self, key, last_modified, checksum=None, size=None):
+        self.put_many([(key, last_modified, checksum, size)])
+
+    def put_many(self, rows):
+        """Insert or replace (key, last_modified, checksum, size) rows."""
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO files (key, last_modified, checksum, size) "
+                "VALUES (?, ?, ?, ?)",
+                rows,
+            )
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
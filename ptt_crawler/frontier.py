@@ -0,0 +1,416 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+
+import scrapy
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider, NotConfigured
+from scrapy.spidermiddlewares.httperror import HttpError
+
+from ptt_crawler.utils import parse_post_url
+
+logger = logging.getLogger(__name__)
+
+PENDING, LEASED, DONE, FAILED = range(4)
+
+
+class SqliteFrontier(object):
+    """Shared frontier in a local SQLite file, for workers on one machine.
+
+    Every URL ever pushed is kept, which makes the table the seen set too;
+    URLs pushed with `revisit` are queued again once they are done.
+    """
+
+    def __init__(self, path: str, name: str, max_attempts: int = 3) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.name = name
+        self.max_attempts = max_attempts
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS frontier ("
+            "name TEXT NOT NULL, "
+            "url TEXT NOT NULL, "
+            "request TEXT, "
+            "priority INTEGER NOT NULL, "
+            "state INTEGER NOT NULL, "
+            "lease_until REAL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "PRIMARY KEY (name, url))"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS frontier_pending "
+            "ON frontier (name, state, priority)"
+        )
+
+    def push(self, entries):
+        """Queue (url, request, priority, revisit) entries not seen before.
+
+        Entries with `revisit` set are queued again if they are done.
+        Returns the number of entries queued.
+        """
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            before = self.conn.total_changes
+            self.conn.executemany(
+                "INSERT INTO frontier (name, url, request, priority, state) "
+                "VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (name, url) DO UPDATE SET request = excluded.request, "
+                "priority = excluded.priority, state = excluded.state, "
+                "lease_until = NULL, attempts = 0 "
+                "WHERE frontier.state = ? AND ?",
+                [
+                    (self.name, url, request, priority, PENDING, DONE, revisit)
+                    for url, request, priority, revisit in entries
+                ],
+            )
+            return self.conn.total_changes - before
+
+    def lease(self, count, ttl):
+        """Lease up to `count` pending requests for `ttl` seconds.
+
+        Leases that expired, i.e. whose worker died or dropped them, are
+        queued again first, unless they already used up their attempts.
+        """
+        now = time.time()
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.execute(
+                "UPDATE frontier SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END "
+                "WHERE name = ? AND state = ? AND lease_until < ?",
+                (self.max_attempts, FAILED, PENDING, self.name, LEASED, now),
+            )
+            rows = self.conn.execute(
+                "SELECT url, request FROM frontier WHERE name = ? AND state = ? "
+                "ORDER BY priority DESC LIMIT ?",
+                (self.name, PENDING, count),
+            ).fetchall()
+            self.conn.executemany(
+                "UPDATE frontier SET state = ?, lease_until = ?, "
+                "attempts = attempts + 1 WHERE name = ? AND url = ?",
+                [(LEASED, now + ttl, self.name, url) for url, _ in rows],
+            )
+        return [request for _, request in rows]
+
+    def done(self, url):
+        self.conn.execute(
+            "UPDATE frontier SET state = ?, request = NULL "
+            "WHERE name = ? AND url = ?",
+            (DONE, self.name, url),
+        )
+
+    def release(self, url):
+        """Queue a leased request again, or fail it once out of attempts."""
+        self.conn.execute(
+            "UPDATE frontier SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, "
+            "lease_until = NULL WHERE name = ? AND url = ? AND state = ?",
+            (self.max_attempts, FAILED, PENDING, self.name, url, LEASED),
+        )
+
+    def counts(self):
+        counts = dict.fromkeys(("pending", "leased", "done", "failed"), 0)
+        rows = self.conn.execute(
+            "SELECT state, COUNT(*) FROM frontier WHERE name = ? GROUP BY state",
+            (self.name,),
+        )
+        for state, count in rows:
+            counts[("pending", "leased", "done", "failed")[state]] = count
+        return counts
+
+    def close(self):
+        self.conn.close()
+
+
+# Requeue expired leases, then move up to ARGV[3] pending URLs to the leased
+# set. Runs as a script so that no URL is lost between the two sets.
+REDIS_LEASE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now)
+for _, url in ipairs(expired) do
+    redis.call('ZREM', KEYS[2], url)
+    if tonumber(redis.call('HGET', KEYS[4], url) or '0') >= tonumber(ARGV[4]) then
+        redis.call('SADD', KEYS[5], url)
+    else
+        local request = cjson.decode(redis.call('HGET', KEYS[3], url))
+        redis.call('ZADD', KEYS[1], -request['priority'], url)
+    end
+end
+local urls = redis.call('ZRANGE', KEYS[1], 0, tonumber(ARGV[3]) - 1)
+local requests = {}
+for i, url in ipairs(urls) do
+    redis.call('ZREM', KEYS[1], url)
+    redis.call('ZADD', KEYS[2], now + tonumber(ARGV[2]), url)
+    redis.call('HINCRBY', KEYS[4], url, 1)
+    requests[i] = redis.call('HGET', KEYS[3], url)
+end
+return requests
+"""
+
+# Queue the (url, request, priority, revisit) entries in ARGV that are not
+# in the seen set, or that are done, i.e. have no request left, and revisit.
+REDIS_PUSH_SCRIPT = """
+local pushed = 0
+for i = 1, #ARGV, 4 do
+    if redis.call('SADD', KEYS[1], ARGV[i]) == 1 or (
+        ARGV[i + 3] == '1' and redis.call('HEXISTS', KEYS[3], ARGV[i]) == 0
+    ) then
+        redis.call('HSET', KEYS[3], ARGV[i], ARGV[i + 1])
+        redis.call('ZADD', KEYS[2], -tonumber(ARGV[i + 2]), ARGV[i])
+        pushed = pushed + 1
+    end
+end
+return pushed
+"""
+
+# Move the leased URL ARGV[1] back to the pending set, or to the failed set
+# once it used up ARGV[2] attempts.
+REDIS_RELEASE_SCRIPT = """
+if redis.call('ZREM', KEYS[2], ARGV[1]) == 0 then
+    return 0
+end
+if tonumber(redis.call('HGET', KEYS[4], ARGV[1]) or '0') >= tonumber(ARGV[2]) then
+    redis.call('SADD', KEYS[5], ARGV[1])
+else
+    local request = cjson.decode(redis.call('HGET', KEYS[3], ARGV[1]))
+    redis.call('ZADD', KEYS[1], -request['priority'], ARGV[1])
+end
+return 1
+"""
+
+
+class RedisFrontier(object):
+    """Shared frontier in Redis, or any server speaking its protocol.
+
+    Keys are prefixed with `name`: a seen set, a sorted set of pending URLs
+    by priority, a sorted set of leased URLs by lease expiry, and hashes of
+    the serialized requests and attempts of URLs not done yet.
+    """
+
+    def __init__(self, url: str, name: str, max_attempts: int = 3) -> None:
+        import redis
+
+        self.name = name
+        self.max_attempts = max_attempts
+        self.redis = redis.Redis.from_url(url)
+        self.keys = {
+            key: "{}:{}".format(name, key)
+            for key in ("seen", "pending", "leased", "requests", "attempts", "failed")
+        }
+        self._push = self.redis.register_script(REDIS_PUSH_SCRIPT)
+        self._lease = self.redis.register_script(REDIS_LEASE_SCRIPT)
+        self._release = self.redis.register_script(REDIS_RELEASE_SCRIPT)
+
+    def push(self, entries):
+        args = []
+        for url, request, priority, revisit in entries:
+            args.extend((url, request, priority, int(revisit)))
+        if not args:
+            return 0
+        keys = self.keys
+        return self._push(
+            keys=[keys["seen"], keys["pending"], keys["requests"]], args=args
+        )
+
+    def _queue_keys(self):
+        keys = self.keys
+        return [
+            keys["pending"],
+            keys["leased"],
+            keys["requests"],
+            keys["attempts"],
+            keys["failed"],
+        ]
+
+    def lease(self, count, ttl):
+        requests = self._lease(
+            keys=self._queue_keys(),
+            args=[time.time(), ttl, count, self.max_attempts],
+        )
+        return [request.decode("utf8") for request in requests]
+
+    def release(self, url):
+        self._release(keys=self._queue_keys(), args=[url, self.max_attempts])
+
+    def done(self, url):
+        keys = self.keys
+        pipe = self.redis.pipeline()
+        pipe.zrem(keys["leased"], url)
+        pipe.hdel(keys["requests"], url)
+        pipe.hdel(keys["attempts"], url)
+        pipe.execute()
+
+    def counts(self):
+        keys = self.keys
+        pipe = self.redis.pipeline()
+        pipe.zcard(keys["pending"])
+        pipe.zcard(keys["leased"])
+        pipe.scard(keys["failed"])
+        pipe.scard(keys["seen"])
+        pending, leased, failed, seen = pipe.execute()
+        return {
+            "pending": pending,
+            "leased": leased,
+            "done": seen - pending - leased - failed,
+            "failed": failed,
+        }
+
+    def close(self):
+        self.redis.close()
+
+
+def open_frontier(uri: str, name: str, max_attempts: int = 3):
+    """Open the frontier at a sqlite:///path or redis://host:port/db URI."""
+    if uri.startswith("sqlite://"):
+        return SqliteFrontier(uri[len("sqlite://") :], name, max_attempts)
+    if uri.startswith(("redis://", "rediss://", "unix://")):
+        return RedisFrontier(uri, name, max_attempts)
+    raise ValueError("Unsupported frontier URI: {}".format(uri))
+
+
+class FrontierMiddleware(object):
+    """Share the requests of a spider between workers through a frontier.
+
+    Requests made by the spider are pushed to the frontier instead of being
+    scheduled, unless they are `dont_filter` ones such as the board index
+    start pages or refreshes. Whenever the spider is idle it leases a batch
+    from the frontier, and keeps running while other workers still hold
+    leases that may come back to the frontier. Leased requests are marked
+    done once their response has been processed, and handed back right away
+    when their download fails. Board index pages list new posts on every
+    run, so they are queued again when pushed after they are done; posts
+    are never crawled twice.
+    """
+
+    def __init__(self, crawler, frontier, batch_size=32, lease_secs=300):
+        self.crawler = crawler
+        self.frontier = frontier
+        self.batch_size = batch_size
+        self.lease_secs = lease_secs
+        self.stats = crawler.stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        uri = settings.get("FRONTIER_URI")
+        if not uri:
+            raise NotConfigured("FRONTIER_URI is not set")
+        frontier = open_frontier(
+            uri,
+            settings.get("FRONTIER_NAME") or crawler.spidercls.name,
+            max_attempts=settings.getint("FRONTIER_MAX_ATTEMPTS", 3),
+        )
+        o = cls(
+            crawler,
+            frontier,
+            batch_size=settings.getint("FRONTIER_BATCH_SIZE", 32),
+            lease_secs=settings.getfloat("FRONTIER_LEASE_SECS", 300),
+        )
+        crawler.signals.connect(o.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        return o
+
+    def process_start_requests(self, start_requests, spider):
+        yield from self._push_requests(start_requests, spider)
+
+    def process_spider_output(self, response, result, spider):
+        yield from self._push_requests(result, spider)
+        self._done(response)
+
+    def process_spider_exception(self, response, exception, spider):
+        self._done(response)
+
+    def _done(self, response):
+        url = response.meta.get("frontier_url")
+        if url is not None:
+            self.frontier.done(url)
+            self.stats.inc_value("frontier/done")
+
+    def _failed(self, failure):
+        """Hand the lease of a failed download back to the frontier.
+
+        Error responses go on to process_spider_exception, which marks them
+        done like any other response.
+        """
+        url = failure.request.meta.get("frontier_url")
+        if url is not None and not failure.check(HttpError):
+            self.frontier.release(url)
+            self.stats.inc_value("frontier/released")
+        return failure
+
+    def _serialize(self, request, spider):
+        callback = getattr(request.callback, "__name__", None)
+        if (
+            request.dont_filter
+            or request.method != "GET"
+            or request.errback is not None
+            or callback is None
+            or getattr(spider, callback, None) != request.callback
+        ):
+            return None
+        try:
+            return json.dumps(
+                {
+                    "url": request.url,
+                    "callback": callback,
+                    "priority": request.priority,
+                    "meta": request.meta,
+                }
+            )
+        except TypeError:
+            return None
+
+    def _push_requests(self, result, spider):
+        entries = []
+        for request_or_item in result:
+            if isinstance(request_or_item, scrapy.Request):
+                request = self._serialize(request_or_item, spider)
+                if request is not None:
+                    url = request_or_item.url
+                    revisit = parse_post_url(url)[1] is None
+                    entries.append((url, request, request_or_item.priority, revisit))
+                    continue
+            yield request_or_item
+        if entries:
+            pushed = self.frontier.push(entries)
+            self.stats.inc_value("frontier/pushed", pushed)
+            self.stats.inc_value("frontier/duplicates", len(entries) - pushed)
+
+    def spider_idle(self, spider):
+        requests = self.frontier.lease(self.batch_size, self.lease_secs)
+        for request in requests:
+            data = json.loads(request)
+            meta = dict(data["meta"], frontier_url=data["url"])
+            self.crawler.engine.crawl(
+                scrapy.Request(
+                    data["url"],
+                    callback=getattr(spider, data["callback"]),
+                    errback=self._failed,
+                    priority=data["priority"],
+                    meta=meta,
+                    # the frontier already filtered it, and an index page
+                    # leased again must not be dropped by the dupefilter
+                    dont_filter=True,
+                )
+            )
+        if requests:
+            self.stats.inc_value("frontier/leased", len(requests))
+            raise DontCloseSpider
+
+        counts = self.frontier.counts()
+        if counts["pending"] or counts["leased"]:
+            # Wait for the leases of other workers to finish or expire.
+            raise DontCloseSpider
+
+    def spider_closed(self, spider):
+        counts = self.frontier.counts()
+        logger.info(
+            "frontier: {pending} pending, {leased} leased, {done} done, "
+            "{failed} failed".format(**counts),
+            extra={"spider": spider},
+        )
+        self.frontier.close()
@@ -0,0 +1,171 @@
+import logging
+import os
+import pickle
+import sqlite3
+import time
+import zlib
+from urllib.parse import urlparse
+
+from scrapy.extensions.httpcache import RFC2616Policy
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.project import data_path
+
+from ptt_crawler.utils import parse_post_url
+
+logger = logging.getLogger(__name__)
+
+
+class SqliteCacheStorage(object):
+    """HTTP cache storage keeping compressed responses in one SQLite file.
+
+    Entries are evicted least recently used first once the compressed
+    responses exceed HTTPCACHE_SQLITE_MAX_SIZE bytes.
+    """
+
+    def __init__(self, settings):
+        self.cachedir = data_path(settings["HTTPCACHE_DIR"], createdir=True)
+        self.expiration_secs = settings.getint("HTTPCACHE_EXPIRATION_SECS")
+        self.max_size = settings.getint("HTTPCACHE_SQLITE_MAX_SIZE", 1024**3)
+        self.compression_level = settings.getint("HTTPCACHE_SQLITE_COMPRESSION", 6)
+        self.conn = None
+        self.stats = None
+        self._size = 0
+
+    def open_spider(self, spider):
+        path = os.path.join(self.cachedir, "{}.sqlite".format(spider.name))
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, "
+            "data BLOB NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "stored REAL NOT NULL, "
+            "accessed REAL NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)"
+        )
+        self._size = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+        logger.debug(
+            "Using SQLite cache storage in %(cachepath)s",
+            {"cachepath": path},
+            extra={"spider": spider},
+        )
+
+        self._fingerprinter = spider.crawler.request_fingerprinter
+        self.stats = spider.crawler.stats
+        self.stats.set_value("httpcache/size_bytes", self._size)
+
+    def close_spider(self, spider):
+        self.conn.close()
+
+    def retrieve_response(self, spider, request):
+        key = self._fingerprinter.fingerprint(request).hex()
+        row = self.conn.execute(
+            "SELECT data, stored FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return  # not cached
+        blob, stored = row
+        now = time.time()
+        if 0 < self.expiration_secs < now - stored:
+            return  # expired
+        self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+
+        data = pickle.loads(zlib.decompress(blob))
+        url = data["url"]
+        headers = Headers(data["headers"])
+        body = data["body"]
+        respcls = responsetypes.from_args(headers=headers, url=url, body=body)
+        return respcls(url=url, headers=headers, status=data["status"], body=body)
+
+    def store_response(self, spider, request, response):
+        key = self._fingerprinter.fingerprint(request).hex()
+        data = {
+            "status": response.status,
+            "url": response.url,
+            "headers": dict(response.headers),
+            "body": response.body,
+        }
+        blob = zlib.compress(pickle.dumps(data, protocol=4), self.compression_level)
+        now = time.time()
+        with self.conn:
+            self.conn.execute("BEGIN")
+            row = self.conn.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                self._size -= row[0]
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, data, size, stored, accessed) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, blob, len(blob), now, now),
+            )
+        self._size += len(blob)
+        self.stats.inc_value("httpcache/stored_bytes", len(blob))
+        self.stats.inc_value("httpcache/raw_bytes", len(response.body))
+        if self._size > self.max_size:
+            self._evict()
+        self.stats.set_value("httpcache/size_bytes", self._size)
+
+    def _evict(self):
+        """Drop least recently used entries until 90% of max_size is free."""
+        target = self.max_size * 0.9
+        with self.conn:
+            self.conn.execute("BEGIN")
+            rows = self.conn.execute(
+                "SELECT key, size FROM responses ORDER BY accessed"
+            )
+            keys = []
+            for key, size in rows:
+                if self._size <= target:
+                    break
+                keys.append((key,))
+                self._size -= size
+            rows.close()
+            self.conn.executemany("DELETE FROM responses WHERE key = ?", keys)
+        self.stats.inc_value("httpcache/evicted", len(keys))
+
+
+class PttCachePolicy(RFC2616Policy):
+    """Cache policy for PTT pages.
+
+    Only ptt.cc pages are cached. Posts rarely change and are served from
+    the cache, while index pages are revalidated on every request with the
+    ETag or Last-Modified of the cached page, whatever its headers. Requests
+    of the spider's refresh mode bypass the cache. With HTTPCACHE_OFFLINE
+    every cached page is served as is, which replays a crawl without
+    touching ptt.cc when combined with HTTPCACHE_IGNORE_MISSING.
+    """
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        self.offline = settings.getbool("HTTPCACHE_OFFLINE")
+
+    def should_cache_request(self, request):
+        host = urlparse(request.url).hostname or ""
+        if host != "ptt.cc" and not host.endswith(".ptt.cc"):
+            return False
+        if request.meta.get("ptt_refresh"):
+            return False
+        return super().should_cache_request(request)
+
+    def should_cache_response(self, response, request):
+        # PTT pages come without validators, which RFC2616Policy requires
+        # before caching a 200 response.
+        if response.status == 200:
+            cc = self._parse_cachecontrol(response)
+            return b"no-store" not in cc
+        return super().should_cache_response(response, request)
+
+    def is_cached_response_fresh(self, cachedresponse, request):
+        if self.offline or parse_post_url(request.url)[1] is not None:
+            return True
+        self._set_conditional_validators(request, cachedresponse)
+        return False
@@ -0,0 +1,146 @@
+import hashlib
+import math
+import os
+import re
+import struct
+from urllib.parse import urlsplit
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif")
+DEFAULT_IMAGE_HOSTS = ("imgur.com",)
+
+# imgur image IDs are 5 or 7 characters; a trailing size letter asks for a
+# thumbnail of the image.
+IMGUR_PATH_RE = re.compile(r"^/([A-Za-z0-9]{5}|[A-Za-z0-9]{7})([sbtmlh])?(\.\w+)?$")
+
+
+def _host_matches(host, domain):
+    return host == domain or host.endswith("." + domain)
+
+
+def canonicalize_imgur(host, path):
+    """Return (image_id, url) of an imgur image link, or None.
+
+    Direct, extensionless and thumbnail links as well as single image pages
+    resolve to the full size image; albums and galleries would need a
+    request to resolve and are skipped.
+    """
+    m = IMGUR_PATH_RE.match(path)
+    if m is None:
+        return None
+    image_id, size, ext = m.groups()
+    if size and not host.startswith("i."):
+        return None
+    ext = (ext or ".jpg").lower()
+    if ext == ".jpeg":
+        ext = ".jpg"
+    if ext not in IMAGE_EXTENSIONS:
+        return None
+    return "imgur:" + image_id, "https://i.imgur.com/{}{}".format(image_id, ext)
+
+
+def canonicalize_image_url(url, hosts=DEFAULT_IMAGE_HOSTS):
+    """Return (image_id, url) of a link to an image on one of `hosts`.
+
+    Links to other hosts, and links that are not to a single image, give
+    None. Query strings and fragments are dropped.
+    """
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        return None
+    host = (parts.hostname or "").lower()
+    if parts.scheme not in ("http", "https"):
+        return None
+    for domain in hosts:
+        if not _host_matches(host, domain):
+            continue
+        if domain == "imgur.com":
+            return canonicalize_imgur(host, parts.path)
+        if not parts.path.lower().endswith(IMAGE_EXTENSIONS):
+            return None
+        netloc = host if port is None else "{}:{}".format(host, port)
+        return netloc + parts.path, "{}://{}{}".format(parts.scheme, netloc, parts.path)
+    return None
+
+
+def extract_image_urls(links, hosts=DEFAULT_IMAGE_HOSTS):
+    """Return the URLs of the images among `links`, one per image.
+
+    Files are stored at a hash of their URL, so a link straight to the full
+    size image is kept as it is; other links to an image are replaced by
+    its canonical URL.
+    """
+    urls = {}
+    for link in links:
+        image = canonicalize_image_url(link, hosts)
+        if image is None:
+            continue
+        image_id, url = image
+        if urlsplit(link.strip()).path == urlsplit(url).path:
+            url = link
+        urls.setdefault(image_id, url)
+    return list(urls.values())
+
+
+class BloomFilter(object):
+    """Bloom filter of strings that can be saved to and loaded from a file."""
+
+    MAGIC = b"PTTBLOOM"
+    HEADER = struct.Struct(">8sQIQ")
+
+    def __init__(self, num_bits, num_hashes, bits=None, count=0):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bits if bits is not None else bytearray((num_bits + 7) // 8)
+        self.count = count
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate=1e-4):
+        num_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        num_hashes = max(round(num_bits / capacity * math.log(2)), 1)
+        return cls(num_bits, num_hashes)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as infile:
+            magic, num_bits, num_hashes, count = cls.HEADER.unpack(
+                infile.read(cls.HEADER.size)
+            )
+            if magic != cls.MAGIC:
+                raise ValueError("{} is not a Bloom filter".format(path))
+            bits = bytearray(infile.read())
+        return cls(num_bits, num_hashes, bits, count)
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as outfile:
+            outfile.write(
+                self.HEADER.pack(self.MAGIC, self.num_bits, self.num_hashes, self.count)
+            )
+            outfile.write(self.bits)
+        os.replace(tmp_path, path)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode("utf8"), digest_size=16).digest()
+        h1, h2 = struct.unpack("<QQ", digest)
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, key):
+        return all(
+            self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key)
+        )
+
+    def add(self, key):
+        """Add `key`; returns False if it was (probably) there already."""
+        added = False
+        for pos in self._positions(key):
+            mask = 1 << (pos & 7)
+            if not self.bits[pos >> 3] & mask:
+                self.bits[pos >> 3] |= mask
+                added = True
+        self.count += added
+        return added
@@ -5,6 +5,11 @@
 
 import scrapy
 
+# Comments are stored column-wise: one list per field, with scores coded as
+# 1 (推), -1 (噓) or 0 (→) and user IDs interned.
+COMMENT_FIELDS = ("user", "content", "score", "ip", "time")
+LEGACY_COMMENT_FIELDS = ("user", "content", "score")
+
 
 class PostItem(scrapy.Item):
     title = scrapy.Field()
@@ -16,3 +21,35 @@ class PostItem(scrapy.Item):
     url = scrapy.Field()
     file_urls = scrapy.Field()
     files = scrapy.Field()
+    # Images already stored for earlier items, taken out of file_urls so
+    # that they are not downloaded again.
+    seen_file_urls = scrapy.Field()
+
+
+class PostDeltaItem(scrapy.Item):
+    """Pushes appended to an already crawled post, keyed by its URL.
+
+    `comments` holds the new pushes column-wise, starting at position
+    `push_offset` of the post's comments.
+    """
+
+    url = scrapy.Field()
+    score = scrapy.Field()
+    push_offset = scrapy.Field()
+    comments = scrapy.Field()
+
+
+def new_comments():
+    return {field: [] for field in COMMENT_FIELDS}
+
+
+def expand_comments(comments, fields=LEGACY_COMMENT_FIELDS):
+    """Expand column-wise comments into a list of dicts with `fields`.
+
+    Lists of dicts, as exported before comments were stored column-wise, are
+    returned unchanged.
+    """
+    if isinstance(comments, list):
+        return comments
+    columns = [comments[field] for field in fields]
+    return [dict(zip(fields, values)) for values in zip(*columns)]
@@ -3,11 +3,21 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import logging
+import time
+
 from scrapy import signals
+from scrapy.core.downloader import Slot
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.httpobj import urlparse_cached
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
 
+from ptt_crawler.profiling import stage_profiled
+
+logger = logging.getLogger(__name__)
+
 
 class PttCrawlerSpiderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
@@ -56,6 +66,52 @@ class PttCrawlerSpiderMiddleware:
         spider.logger.info('Spider opened: %s' % spider.name)
 
 
+class PttProfilingSpiderMiddleware(PttCrawlerSpiderMiddleware):
+    """Report download latency and callback time to ProfilingExtension.
+
+    Callback time is the time spent producing the callback's output, so this
+    middleware should sit right next to the spider.
+    """
+
+    def __init__(self, crawler):
+        self.signals = crawler.signals
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('PROFILING_ENABLED'):
+            raise NotConfigured
+        s = cls(crawler)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        return s
+
+    def process_spider_input(self, response, spider):
+        latency = response.meta.get('download_latency')
+        if latency is not None:
+            self.signals.send_catch_log(
+                stage_profiled, stage='download', seconds=latency,
+                size=len(response.body),
+            )
+        return None
+
+    def process_spider_output(self, response, result, spider):
+        callback = response.request.callback or spider.parse
+        stage = 'callback/%s' % getattr(callback, '__name__', 'unknown')
+        elapsed = 0.0
+        results = iter(result)
+        while True:
+            start = time.perf_counter()
+            try:
+                i = next(results)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - start
+            yield i
+        self.signals.send_catch_log(
+            stage_profiled, stage=stage, seconds=elapsed, size=len(response.body)
+        )
+
+
 class PttCrawlerDownloaderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
     # scrapy acts as if the downloader middleware does not modify the
@@ -101,3 +157,159 @@ class PttCrawlerDownloaderMiddleware:
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+
+class DomainThrottle:
+    """Download delay and concurrency of one throttled domain."""
+
+    def __init__(self, start_delay=0.0, min_delay=0.0, max_delay=60.0,
+                 start_concurrency=1, max_concurrency=8, target_latency=1.0):
+        self.delay = start_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.concurrency = start_concurrency
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.healthy = 0
+
+    def back_off(self, retry_after=0.0):
+        """Halve the concurrency and at least double the delay."""
+        self.healthy = 0
+        self.concurrency = max(self.concurrency // 2, 1)
+        self.delay = min(max(self.delay * 2, retry_after, 1.0), self.max_delay)
+
+    def observe(self, latency):
+        """Adjust to the latency of a successful download.
+
+        Slow downloads take one off the concurrency, or once it is down to
+        one, increase the delay. After a round of `concurrency` downloads
+        within the target latency the delay is halved down to its minimum,
+        and after that the concurrency grows by one per round.
+        """
+        if latency > self.target_latency:
+            self.healthy = 0
+            if self.concurrency > 1:
+                self.concurrency -= 1
+            else:
+                self.delay = min(max(self.delay * 1.5, 0.1), self.max_delay)
+            return
+
+        self.healthy += 1
+        if self.healthy < self.concurrency:
+            return
+        self.healthy = 0
+        if self.delay > self.min_delay:
+            self.delay = max(self.delay / 2, self.min_delay)
+            if self.delay < 0.05:
+                self.delay = self.min_delay
+        elif self.concurrency < self.max_concurrency:
+            self.concurrency += 1
+
+
+class PttThrottleMiddleware(PttCrawlerDownloaderMiddleware):
+    """Throttle ptt.cc and image hosts separately.
+
+    Requests to each domain in PTT_THROTTLE_DOMAINS share one downloader
+    slot, whose delay and concurrency follow the download latency of the
+    domain: they grow while latency stays under the domain's target and
+    back off on 429/503 responses and on redirects to the over18 page.
+    Other domains keep the default slots.
+    """
+
+    DEFAULT_DOMAINS = {
+        'ptt.cc': {
+            'start_delay': 1.0,
+            'min_delay': 0.25,
+            'max_delay': 60.0,
+            'start_concurrency': 1,
+            'max_concurrency': 4,
+            'target_latency': 1.0,
+        },
+        'imgur.com': {
+            'start_delay': 0.0,
+            'min_delay': 0.0,
+            'max_delay': 30.0,
+            'start_concurrency': 8,
+            'max_concurrency': 32,
+            'target_latency': 2.0,
+        },
+    }
+
+    def __init__(self, crawler, domains):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.throttles = {
+            domain: DomainThrottle(**options) for domain, options in domains.items()
+        }
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        domains = (
+            crawler.settings.getdict('PTT_THROTTLE_DOMAINS') or cls.DEFAULT_DOMAINS
+        )
+        s = cls(crawler, domains)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        return s
+
+    def _get_domain(self, request):
+        host = urlparse_cached(request).hostname or ''
+        for domain in self.throttles:
+            if host == domain or host.endswith('.' + domain):
+                return domain
+        return None
+
+    def _apply(self, domain):
+        throttle = self.throttles[domain]
+        downloader = self.crawler.engine.downloader
+        slot = downloader.slots.get(domain)
+        if slot is None:
+            downloader.slots[domain] = Slot(
+                throttle.concurrency, throttle.delay, downloader.randomize_delay
+            )
+        else:
+            slot.concurrency = throttle.concurrency
+            slot.delay = throttle.delay
+        self.stats.set_value('throttle/%s/delay' % domain, throttle.delay)
+        self.stats.set_value('throttle/%s/concurrency' % domain, throttle.concurrency)
+
+    def process_request(self, request, spider):
+        domain = self._get_domain(request)
+        if domain is not None and 'download_slot' not in request.meta:
+            request.meta['download_slot'] = domain
+            # Slots are dropped once idle, so make sure one with the current
+            # settings is there.
+            if domain not in self.crawler.engine.downloader.slots:
+                self._apply(domain)
+        return None
+
+    def process_response(self, request, response, spider):
+        domain = self._get_domain(request)
+        if domain is None or 'cached' in response.flags:
+            return response
+
+        throttle = self.throttles[domain]
+        location = response.headers.get('Location', b'')
+        if response.status in (429, 503) or b'/ask/over18' in location:
+            try:
+                retry_after = float(response.headers.get('Retry-After', 0))
+            except ValueError:
+                retry_after = 0.0
+            throttle.back_off(retry_after)
+            self.stats.inc_value('throttle/%s/backoffs' % domain)
+            logger.info(
+                'Backing off %(domain)s after %(status)d: delay %(delay).2fs, '
+                'concurrency %(concurrency)d',
+                {
+                    'domain': domain,
+                    'status': response.status,
+                    'delay': throttle.delay,
+                    'concurrency': throttle.concurrency,
+                },
+                extra={'spider': spider},
+            )
+        elif response.status < 400 and 'download_latency' in request.meta:
+            throttle.observe(request.meta['download_latency'])
+        else:
+            return response
+        self._apply(domain)
+        return response
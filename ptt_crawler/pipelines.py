@@ -6,42 +6,78 @@
 import os
 import functools
 import logging
+import tempfile
+import time
 
 from io import BytesIO
 
-import boto3
-from botocore.config import Config
-from cryptography.fernet import Fernet
-from scrapy.pipelines.files import FilesPipeline
+from scrapy.pipelines.files import FileException, FilesPipeline
+from scrapy import signals
 from scrapy.exceptions import NotConfigured, CloseSpider
 from scrapy.utils.misc import load_object
 from scrapy.utils.misc import md5sum
+from scrapy.utils.log import failure_to_exc_info
 from scrapy.utils.python import without_none_values
 from twisted.internet import threads
+from twisted.python.threadpool import ThreadPool
 
 # useful for handling different item types with a single interface
 from itemadapter import ItemAdapter
 
+from ptt_crawler.b2 import get_b2_client
+from ptt_crawler.b2 import get_transfer_config
+from ptt_crawler.fileindex import FilesIndex
+from ptt_crawler.fileindex import etag_checksum
+from ptt_crawler.images import DEFAULT_IMAGE_HOSTS
+from ptt_crawler.images import BloomFilter
+from ptt_crawler.images import canonicalize_image_url
+from ptt_crawler.items import COMMENT_FIELDS
+from ptt_crawler.items import PostItem
+from ptt_crawler.items import expand_comments
+from ptt_crawler.items import new_comments
+from ptt_crawler.profiling import stage_profiled
+from ptt_crawler.search import SearchIndex
+from ptt_crawler.uploads import UploadScheduler
+from ptt_crawler.utils import parse_post_url
+
 logger = logging.getLogger(__name__)
 
 
-def get_b2_resource(endpoint: str, key_id: str, application_key: str):
-    b2 = boto3.resource(
-        service_name="s3",
-        endpoint_url=endpoint,  # Backblaze endpoint
-        aws_access_key_id=key_id,  # Backblaze keyID
-        aws_secret_access_key=application_key,  # Backblaze applicationKey
-        config=Config(
-            signature_version="s3v4",
-        ),
-    )
-    return b2
+class _KeepOpen(object):
+    """File object that ignores `close`, for uploads that close what they read."""
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
+
+    def close(self):
+        pass
+
+
+class _SpooledBuffer(tempfile.SpooledTemporaryFile):
+    """Temporary file kept in memory up to `max_size` bytes, then on disk.
+
+    `getvalue` reads it whole, for the files stores that upload bytes.
+    """
+
+    def getvalue(self):
+        position = self.tell()
+        self.seek(0)
+        data = self.read()
+        self.seek(position)
+        return data
 
 
 class B2FilesStore(object):
     B2_ENDPOINT = None
     B2_KEY_ID = None
     B2_APPLICATION_KEY = None
+    B2_MAX_POOL_CONNECTIONS = 20
+    B2_TRANSFER_CONFIG = None
+    B2_FILES_INDEX = None
+    B2_FILES_HEAD_FALLBACK = True
 
     def __init__(self, uri: str) -> None:
         try:
@@ -53,34 +89,103 @@ class B2FilesStore(object):
                 self.bucket = buckets_and_prefix[0]
                 self.prefix = None
 
-            self.b2 = get_b2_resource(
+            self.client = get_b2_client(
                 endpoint=self.B2_ENDPOINT,
                 key_id=self.B2_KEY_ID,
                 application_key=self.B2_APPLICATION_KEY,
+                max_pool_connections=self.B2_MAX_POOL_CONNECTIONS,
             )
-            self.c = self._get_b2_bucket()
         except (AssertionError, Exception) as e:
             logger.exception(e)
             raise CloseSpider("could not initialize B2")
 
+        if self.B2_FILES_INDEX:
+            self.index = FilesIndex(self.B2_FILES_INDEX)
+            logger.info(
+                "loaded B2 files index %s with %d files",
+                self.B2_FILES_INDEX,
+                len(self.index),
+            )
+        else:
+            self.index = None
+
+    def _key_name(self, path):
+        if self.prefix:
+            return os.path.join(self.prefix, path)
+        return path
+
     def stat_file(self, path, info):
-        return {}
+        """Look up a file in the local index, then in the bucket itself."""
+        key_name = self._key_name(path)
+        if self.index is not None:
+            stat = self.index.get(key_name)
+            if stat is not None:
+                return stat
+        if not self.B2_FILES_HEAD_FALLBACK:
+            return {}
+
+        def _record(stat):
+            if stat and self.index is not None:
+                self.index.put(
+                    key_name, stat["last_modified"], stat["checksum"], stat["size"]
+                )
+            return stat
 
-    def _get_b2_bucket(self):
-        return self.b2.Bucket(self.bucket)
+        dfd = threads.deferToThread(self._head_file, key_name)
+        return dfd.addCallback(_record)
 
-    def _upload_file(self, buf, file_name):
-        self.c.upload_fileobj(buf, file_name)
+    def _head_file(self, key_name):
+        from botocore.exceptions import ClientError
+
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=key_name)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return {}
+            raise
+        checksum = response.get("Metadata", {}).get("checksum")
+        if checksum is None:
+            checksum = etag_checksum(response["ETag"])
+        return {
+            "last_modified": response["LastModified"].timestamp(),
+            "checksum": checksum,
+            "size": response["ContentLength"],
+        }
+
+    def _upload_file(self, buf, file_name, meta=None):
+        extra_args = {"Metadata": meta} if meta else None
+        # boto3 closes the file object it uploads; keep `buf` open so that a
+        # failed upload can rewind and retry it
+        buf.seek(0)
+        self.client.upload_fileobj(
+            _KeepOpen(buf),
+            self.bucket,
+            file_name,
+            ExtraArgs=extra_args,
+            Config=self.B2_TRANSFER_CONFIG,
+        )
 
     def persist_file(self, path, buf, info, meta=None, headers=None):
         """Upload file to B2 storage"""
-        if self.prefix:
-            key_name = os.path.join(self.prefix, path)
-        else:
-            key_name = path
+        key_name = self._key_name(path)
+        buf.seek(0, os.SEEK_END)
+        size = buf.tell()
         buf.seek(0)
 
-        return threads.deferToThread(self._upload_file, buf=buf, file_name=key_name)
+        def _record(result):
+            if self.index is not None:
+                checksum = meta.get("checksum") if meta else None
+                self.index.put(key_name, time.time(), checksum, size)
+            return result
+
+        dfd = threads.deferToThread(
+            self._upload_file, buf=buf, file_name=key_name, meta=meta
+        )
+        return dfd.addCallback(_record)
+
+    def close(self):
+        if self.index is not None:
+            self.index.close()
 
 
 class EncryptedFilesPipeline(FilesPipeline):
@@ -94,10 +199,31 @@ class EncryptedFilesPipeline(FilesPipeline):
 
         encryption_key = settings.get(resolve("FILES_ENCRYPTION_KEY"))
         if encryption_key is not None:
-            self.cipher = Fernet(encryption_key)
+            from ptt_crawler.crypto import DEFAULT_CHUNK_SIZE, StreamCipher
+
+            chunk_size = settings.getint(
+                resolve("FILES_ENCRYPTION_CHUNK_SIZE"), DEFAULT_CHUNK_SIZE
+            )
+            self.cipher = StreamCipher(encryption_key, chunk_size=chunk_size)
         else:
             self.cipher = None
 
+        self.encryption_threads = settings.getint(
+            resolve("FILES_ENCRYPTION_THREADS"), 4
+        )
+        self.encryption_spool_size = settings.getint(
+            resolve("FILES_ENCRYPTION_SPOOL_SIZE"), 1024 * 1024
+        )
+        self._threadpool = None
+
+        self.upload_concurrency = settings.getint(
+            resolve("FILES_UPLOAD_CONCURRENCY"), 4
+        )
+        self.upload_queue_size = settings.getint(resolve("FILES_UPLOAD_QUEUE_SIZE"), 16)
+        self.upload_retries = settings.getint(resolve("FILES_UPLOAD_RETRIES"), 3)
+        self.upload_backoff = settings.getfloat(resolve("FILES_UPLOAD_BACKOFF"), 1.0)
+        self.uploads = None
+
     @classmethod
     def from_settings(cls, settings):
         cls.STORE_SCHEMES = cls._load_components(settings, "FILES_STORES")
@@ -105,7 +231,15 @@ class EncryptedFilesPipeline(FilesPipeline):
         b2store.B2_ENDPOINT = settings["B2_ENDPOINT"]
         b2store.B2_KEY_ID = settings["B2_KEY_ID"]
         b2store.B2_APPLICATION_KEY = settings["B2_APPLICATION_KEY"]
+        b2store.B2_MAX_POOL_CONNECTIONS = settings.getint("B2_MAX_POOL_CONNECTIONS", 20)
+        b2store.B2_FILES_INDEX = settings.get("B2_FILES_INDEX")
+        b2store.B2_FILES_HEAD_FALLBACK = settings.getbool(
+            "B2_FILES_HEAD_FALLBACK", True
+        )
         store_uri = settings["FILES_STORE"]
+        # Building the transfer config loads boto3, which only B2 stores need.
+        if store_uri and store_uri.startswith("b2://"):
+            b2store.B2_TRANSFER_CONFIG = get_transfer_config(settings)
         return cls(store_uri, settings=settings)
 
     @staticmethod
@@ -119,13 +253,426 @@ class EncryptedFilesPipeline(FilesPipeline):
                 pass
         return d
 
-    def file_downloaded(self, response, request, info, *, item=None):
-        path = self.file_path(request, response=response, info=info)
+    def open_spider(self, spider):
+        super().open_spider(spider)
+        self._threadpool = ThreadPool(
+            minthreads=0,
+            maxthreads=self.encryption_threads,
+            name="EncryptedFilesPipeline",
+        )
+        self._threadpool.start()
+        self.uploads = UploadScheduler(
+            self.store,
+            concurrency=self.upload_concurrency,
+            queue_size=self.upload_queue_size,
+            retries=self.upload_retries,
+            backoff=self.upload_backoff,
+            stats=spider.crawler.stats,
+        )
+
+    def close_spider(self, spider):
+        def _close(result):
+            if self._threadpool is not None:
+                self._threadpool.stop()
+                self._threadpool = None
+            if hasattr(self.store, "close"):
+                self.store.close()
+            return result
+
+        return self.uploads.drain().addBoth(_close)
+
+    def _process_body(self, body):
         if self.cipher is not None:
-            buf = BytesIO(self.cipher.encrypt(response.body))
+            # BytesIO shares the bytes of the body without copying them, and
+            # the ciphertext of large files goes to disk
+            buf = _SpooledBuffer(max_size=self.encryption_spool_size)
+            checksum = self.cipher.encrypt_stream(BytesIO(body), buf)
         else:
-            buf = BytesIO(response.body)
-        checksum = md5sum(buf)
+            buf = BytesIO(body)
+            checksum = md5sum(buf)
         buf.seek(0)
-        self.store.persist_file(path, buf, info)
-        return checksum
+        return buf, checksum
+
+    def media_to_download(self, request, info, *, item=None):
+        """Wait for room in the upload queue before the file is downloaded.
+
+        The room is freed by `media_failed` or `media_downloaded`, or right
+        away if the file is already stored.
+        """
+        started = time.perf_counter()
+        stat_file = functools.partial(
+            super().media_to_download, request, info, item=item
+        )
+
+        def _entered(_):
+            self._profile("file_queue", started)
+            return stat_file()
+
+        def _checked(result):
+            if result is not None:
+                self.uploads.leave()
+            return result
+
+        dfd = self.uploads.enter()
+        dfd.addCallback(_entered)
+        dfd.addBoth(_checked)
+        return dfd
+
+    def media_failed(self, failure, request, info):
+        self.uploads.leave()
+        return super().media_failed(failure, request, info)
+
+    def media_downloaded(self, response, request, info, *, item=None):
+        try:
+            result = super().media_downloaded(response, request, info, item=item)
+        except Exception:
+            self.uploads.leave()
+            raise
+
+        def _persisted(checksum):
+            result["checksum"] = checksum
+            return result
+
+        def _failed(failure):
+            logger.error(
+                "File (unknown-error): Error processing file from %(request)s",
+                {"request": request},
+                exc_info=failure_to_exc_info(failure),
+                extra={"spider": info.spider},
+            )
+            raise FileException(str(failure.value))
+
+        dfd = result["checksum"].addBoth(self.uploads.leave)
+        return dfd.addCallbacks(_persisted, _failed)
+
+    def _profile(self, stage, started, size=0):
+        """Report the time of a stage since `started` and restart the clock."""
+        now = time.perf_counter()
+        self.crawler.signals.send_catch_log(
+            stage_profiled, stage=stage, seconds=now - started, size=size
+        )
+        return now
+
+    def file_downloaded(self, response, request, info, *, item=None):
+        """Encrypt and checksum off the reactor thread, then upload the file.
+
+        Returns a Deferred firing with the checksum once the upload is done.
+        """
+        from twisted.internet import reactor
+
+        path = self.file_path(request, response=response, info=info)
+        size = len(response.body)
+        started = time.perf_counter()
+
+        def _persist(result):
+            buf, checksum = result
+            encrypted = self._profile("file_encrypt", started, size)
+
+            def _uploaded(_):
+                self._profile("file_upload", encrypted, size)
+                return checksum
+
+            def _close(result):
+                buf.close()
+                return result
+
+            dfd = self.uploads.upload(path, buf, info, meta={"checksum": checksum})
+            dfd.addCallback(_uploaded)
+            dfd.addBoth(_close)
+            return dfd
+
+        dfd = threads.deferToThreadPool(
+            reactor, self._threadpool, self._process_body, response.body
+        )
+        dfd.addCallback(_persist)
+        return dfd
+
+
+class ImageDedupPipeline(object):
+    """Take images stored by earlier items out of `file_urls`.
+
+    Canonical image IDs are kept in a Bloom filter saved to
+    IMAGE_DEDUP_FILTER. An image is added once the files pipeline has stored
+    it, so failed downloads are tried again later, and images already
+    requested in this run are taken out as well.
+    """
+
+    def __init__(self, path, capacity, error_rate, hosts, stats):
+        self.path = path
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.hosts = hosts
+        self.stats = stats
+        self.bloom = None
+        self.requested = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        path = settings.get("IMAGE_DEDUP_FILTER")
+        if not path:
+            raise NotConfigured("IMAGE_DEDUP_FILTER is not set")
+        o = cls(
+            path,
+            capacity=settings.getint("IMAGE_DEDUP_CAPACITY", 10000000),
+            error_rate=settings.getfloat("IMAGE_DEDUP_ERROR_RATE", 1e-4),
+            hosts=settings.getlist("IMAGE_HOSTS", DEFAULT_IMAGE_HOSTS),
+            stats=crawler.stats,
+        )
+        crawler.signals.connect(o.item_scraped, signal=signals.item_scraped)
+        return o
+
+    def _image_id(self, url):
+        image = canonicalize_image_url(url, self.hosts)
+        return image[0] if image is not None else url
+
+    def open_spider(self, spider):
+        if os.path.exists(self.path):
+            self.bloom = BloomFilter.load(self.path)
+            logger.info("loaded %d image IDs from %s", self.bloom.count, self.path)
+        else:
+            self.bloom = BloomFilter.for_capacity(self.capacity, self.error_rate)
+
+    def process_item(self, item, spider):
+        adapter = ItemAdapter(item)
+        file_urls = adapter.get("file_urls")
+        if not file_urls:
+            return item
+
+        new_urls = []
+        seen_urls = []
+        for url in file_urls:
+            image_id = self._image_id(url)
+            if image_id in self.requested or image_id in self.bloom:
+                seen_urls.append(url)
+            else:
+                self.requested.add(image_id)
+                new_urls.append(url)
+        if seen_urls:
+            adapter["file_urls"] = new_urls
+            adapter["seen_file_urls"] = seen_urls
+            self.stats.inc_value("image_dedup/dropped", len(seen_urls))
+        return item
+
+    def item_scraped(self, item, response, spider):
+        for file in ItemAdapter(item).get("files") or []:
+            self.bloom.add(self._image_id(file["url"]))
+
+    def close_spider(self, spider):
+        self.bloom.save(self.path)
+        self.stats.set_value("image_dedup/filter_count", self.bloom.count)
+
+
+class _ParquetPartition(object):
+    """Buffered Parquet writers of one board/month partition."""
+
+    def __init__(self, pipeline, partition):
+        self.pipeline = pipeline
+        self.partition = partition
+        self.posts = []
+        self.comments = []
+        self.part = 0
+        self.writers = None
+
+    def add(self, post, comments):
+        self.posts.append(post)
+        self.comments.extend(comments)
+        if len(self.posts) >= self.pipeline.row_group_size:
+            self.flush()
+
+    def _open(self):
+        self.writers = {}
+        for table, schema in self.pipeline.schemas.items():
+            directory = os.path.join(self.pipeline.export_dir, table, self.partition)
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(
+                directory,
+                "part-{}-{:05d}.parquet".format(self.pipeline.run_id, self.part),
+            )
+            self.writers[table] = (
+                path,
+                self.pipeline.pq.ParquetWriter(
+                    path, schema, compression=self.pipeline.compression
+                ),
+            )
+        self.part += 1
+
+    def flush(self):
+        if not self.posts:
+            return
+        if self.writers is None:
+            self._open()
+        pa = self.pipeline.pa
+        for table, rows in [("posts", self.posts), ("comments", self.comments)]:
+            # one write_table call per batch makes one row group
+            _, writer = self.writers[table]
+            schema = self.pipeline.schemas[table]
+            writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+        self.posts = []
+        self.comments = []
+
+        max_file_size = self.pipeline.max_file_size
+        if any(
+            os.path.getsize(path) >= max_file_size for path, _ in self.writers.values()
+        ):
+            self.close()
+
+    def close(self):
+        if self.writers is not None:
+            for _, writer in self.writers.values():
+                writer.close()
+            self.writers = None
+
+
+class ParquetExportPipeline(object):
+    """Write posts and their comments to Parquet, partitioned by board and month.
+
+    Posts go to `posts/board=<board>/month=<YYYY-MM>/` and comments to a
+    matching `comments/` table keyed by `post_id`.
+    """
+
+    def __init__(
+        self, export_dir, row_group_size=1000, max_file_size=128 * 1024 * 1024
+    ):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.pq = pq
+        self.export_dir = export_dir
+        self.row_group_size = row_group_size
+        self.max_file_size = max_file_size
+        self.compression = "zstd"
+        self.run_id = os.environ.get(
+            "SHUB_JOBKEY", time.strftime("%Y%m%d%H%M%S")
+        ).replace("/", "-")
+        self.schemas = {
+            "posts": pa.schema(
+                [
+                    ("post_id", pa.string()),
+                    ("url", pa.string()),
+                    ("title", pa.string()),
+                    ("author", pa.string()),
+                    ("date", pa.timestamp("s")),
+                    ("score", pa.int32()),
+                    ("comment_count", pa.int32()),
+                    ("content", pa.string()),
+                    ("file_urls", pa.list_(pa.string())),
+                ]
+            ),
+            "comments": pa.schema(
+                [
+                    ("post_id", pa.string()),
+                    ("position", pa.int32()),
+                    ("user", pa.string()),
+                    ("content", pa.string()),
+                    ("score", pa.int8()),
+                    ("ip", pa.string()),
+                    ("time", pa.string()),
+                ]
+            ),
+        }
+        self.partitions = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        export_dir = settings.get("PARQUET_EXPORT_DIR")
+        if not export_dir:
+            raise NotConfigured("PARQUET_EXPORT_DIR is not set")
+        return cls(
+            export_dir,
+            row_group_size=settings.getint("PARQUET_ROW_GROUP_SIZE", 1000),
+            max_file_size=settings.getint("PARQUET_MAX_FILE_SIZE", 128 * 1024 * 1024),
+        )
+
+    def process_item(self, item, spider):
+        if not isinstance(item, PostItem):
+            return item
+        adapter = ItemAdapter(item)
+        board_name, post_id = parse_post_url(adapter["url"])
+        date = adapter.get("date")
+        partition = "board={}/month={}".format(
+            board_name, date.strftime("%Y-%m") if date else "unknown"
+        )
+
+        comments = adapter.get("comments") or new_comments()
+        post = {
+            "post_id": post_id,
+            "url": adapter["url"],
+            "title": adapter.get("title"),
+            "author": adapter.get("author"),
+            "date": date,
+            "score": adapter.get("score"),
+            "comment_count": len(comments["user"]),
+            "content": adapter.get("content"),
+            "file_urls": (adapter.get("file_urls") or [])
+            + (adapter.get("seen_file_urls") or []),
+        }
+        comment_rows = [
+            {
+                "post_id": post_id,
+                "position": position,
+                "user": user,
+                "content": content,
+                "score": score,
+                "ip": ip,
+                "time": time,
+            }
+            for position, (user, content, score, ip, time) in enumerate(
+                zip(*(comments[field] for field in COMMENT_FIELDS))
+            )
+        ]
+
+        if partition not in self.partitions:
+            self.partitions[partition] = _ParquetPartition(self, partition)
+        self.partitions[partition].add(post, comment_rows)
+        return item
+
+    def close_spider(self, spider):
+        for partition in self.partitions.values():
+            partition.flush()
+            partition.close()
+
+
+class SearchIndexPipeline(object):
+    """Add posts to the full-text search index at SEARCH_INDEX_PATH."""
+
+    def __init__(self, path, batch_size=1000):
+        self.path = path
+        self.batch_size = batch_size
+        self.index = None
+        self.pending = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        path = settings.get("SEARCH_INDEX_PATH")
+        if not path:
+            raise NotConfigured("SEARCH_INDEX_PATH is not set")
+        return cls(path, batch_size=settings.getint("SEARCH_INDEX_BATCH_SIZE", 1000))
+
+    def open_spider(self, spider):
+        self.index = SearchIndex(self.path)
+
+    def process_item(self, item, spider):
+        if not isinstance(item, PostItem):
+            return item
+        adapter = ItemAdapter(item)
+        comments = expand_comments(adapter.get("comments") or [], ("content",))
+        self.index.add(
+            adapter["url"],
+            adapter.get("title"),
+            adapter.get("content"),
+            [comment["content"] for comment in comments],
+            date=adapter.get("date"),
+            score=adapter.get("score"),
+        )
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.index.flush()
+            self.pending = 0
+        return item
+
+    def close_spider(self, spider):
+        self.index.close()
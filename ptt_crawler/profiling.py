@@ -0,0 +1,185 @@
+import cProfile
+import json
+import logging
+import math
+import os
+import signal
+import time
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import task
+
+logger = logging.getLogger(__name__)
+
+# Sent with stage, seconds and size arguments whenever a stage of the crawl
+# has processed something, e.g. a callback has parsed a response.
+stage_profiled = object()
+
+
+class Histogram(object):
+    """Latency histogram with power-of-two buckets from 1µs to ~18 minutes."""
+
+    BUCKETS = 31
+
+    def __init__(self):
+        self.buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.bytes = 0
+
+    def add(self, seconds, size=0):
+        micros = seconds * 1e6
+        index = math.ceil(math.log2(micros)) if micros > 1 else 0
+        self.buckets[min(index, self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.bytes += size
+
+    def percentile(self, q):
+        """Return the upper bound in seconds of the bucket holding quantile q."""
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(2**index / 1e6, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "bytes": self.bytes,
+            "mean_ms": self.total / self.count * 1000 if self.count else 0.0,
+            "p50_ms": self.percentile(0.5) * 1000,
+            "p90_ms": self.percentile(0.9) * 1000,
+            "p99_ms": self.percentile(0.99) * 1000,
+            "max_ms": self.max * 1000,
+        }
+
+
+class ProfilingExtension(object):
+    """Collect per-stage latency histograms of the crawl.
+
+    Stages are reported through the `stage_profiled` signal, by
+    PttProfilingSpiderMiddleware for downloads and callbacks and by the
+    files pipeline for encryption and uploads. Summaries go to the stats
+    under profile/<stage>/ and, every PROFILING_INTERVAL seconds, to the
+    PROFILING_METRICS_FILE JSON lines file, one line per interval.
+
+    Sending SIGUSR2 to the process profiles the reactor thread, where
+    callbacks run, for PROFILING_SNAPSHOT_SECS and dumps it with cProfile
+    into PROFILING_DIR.
+    """
+
+    def __init__(
+        self,
+        crawler,
+        metrics_file=None,
+        interval=60.0,
+        profile_dir=".",
+        snapshot_secs=30.0,
+    ):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.metrics_file = metrics_file
+        self.interval = interval
+        self.profile_dir = profile_dir
+        self.snapshot_secs = snapshot_secs
+        self.totals = {}
+        self.window = {}
+        self._outfile = None
+        self._task = None
+        self._profile = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool("PROFILING_ENABLED"):
+            raise NotConfigured
+        o = cls(
+            crawler,
+            metrics_file=settings.get("PROFILING_METRICS_FILE"),
+            interval=settings.getfloat("PROFILING_INTERVAL", 60.0),
+            profile_dir=settings.get("PROFILING_DIR", "."),
+            snapshot_secs=settings.getfloat("PROFILING_SNAPSHOT_SECS", 30.0),
+        )
+        crawler.signals.connect(o.stage_profiled, signal=stage_profiled)
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        return o
+
+    def stage_profiled(self, stage, seconds, size=0):
+        for histograms in (self.totals, self.window):
+            histogram = histograms.get(stage)
+            if histogram is None:
+                histogram = histograms[stage] = Histogram()
+            histogram.add(seconds, size)
+
+    def spider_opened(self, spider):
+        if self.metrics_file:
+            directory = os.path.dirname(self.metrics_file)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._outfile = open(self.metrics_file, "a", encoding="utf8")
+        self._task = task.LoopingCall(self.flush)
+        self._task.start(self.interval, now=False)
+        if hasattr(signal, "SIGUSR2"):
+            signal.signal(signal.SIGUSR2, self._on_sigusr2)
+
+    def spider_closed(self, spider):
+        if self._task is not None and self._task.running:
+            self._task.stop()
+        self.flush()
+        if self._outfile is not None:
+            self._outfile.close()
+        if self._profile is not None:
+            self.stop_snapshot()
+
+    def flush(self):
+        """Write the interval's summaries and update the stats."""
+        for stage, histogram in self.totals.items():
+            for key, value in histogram.summary().items():
+                self.stats.set_value("profile/{}/{}".format(stage, key), value)
+
+        if self._outfile is not None and self.window:
+            line = {
+                "time": time.time(),
+                "interval": self.interval,
+                "stages": {
+                    stage: histogram.summary()
+                    for stage, histogram in sorted(self.window.items())
+                },
+            }
+            self._outfile.write(json.dumps(line) + "\n")
+            self._outfile.flush()
+        self.window = {}
+
+    def _on_sigusr2(self, signum, frame):
+        from twisted.internet import reactor
+
+        reactor.callFromThread(self.start_snapshot)
+
+    def start_snapshot(self):
+        from twisted.internet import reactor
+
+        if self._profile is not None:
+            return
+        logger.warning("profiling callbacks for %gs", self.snapshot_secs)
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        reactor.callLater(self.snapshot_secs, self.stop_snapshot)
+
+    def stop_snapshot(self):
+        if self._profile is None:
+            return
+        self._profile.disable()
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(
+            self.profile_dir, "profile-{}.prof".format(time.strftime("%Y%m%d-%H%M%S"))
+        )
+        self._profile.dump_stats(path)
+        self._profile = None
+        logger.warning("profile written to %s", path)
@@ -0,0 +1,356 @@
+import logging
+import os
+import re
+import sqlite3
+import unicodedata
+from collections import defaultdict
+from datetime import datetime
+
+from ptt_crawler.utils import parse_post_url
+
+logger = logging.getLogger(__name__)
+
+# Runs of CJK characters are indexed as overlapping bigrams, other words and
+# numbers as a whole.
+CJK_CHARS = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff"
+TOKEN_RE = re.compile(r"[{0}]+|[^\W_{0}]+".format(CJK_CHARS))
+CJK_RE = re.compile(r"[{}]".format(CJK_CHARS))
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Version 2 indexes every CJK character as a term of its own; version 1 only
+# the last one of each run.
+INDEX_VERSION = 2
+
+# Queries matching at least 1/DENSE_MATCHES of the posts walk the posts
+# newest first until `limit` of them match, instead of sorting every match.
+DENSE_MATCHES = 64
+
+RESULT_FIELDS = ("doc_id", "url", "board", "date", "score", "title")
+
+
+def tokenize(text):
+    """Yield the terms of `text`: CJK bigrams and lowercased words.
+
+    Every CJK character is a term too, so that a single character query
+    reads one postings list.
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    for m in TOKEN_RE.finditer(text):
+        token = m.group()
+        if CJK_RE.match(token):
+            for i in range(len(token) - 1):
+                yield token[i : i + 2]
+            yield from token
+        else:
+            yield token
+
+
+def tokenize_query(text):
+    """Like `tokenize`, without the single characters of CJK runs."""
+    text = unicodedata.normalize("NFKC", text).lower()
+    for m in TOKEN_RE.finditer(text):
+        token = m.group()
+        if len(token) > 1 and CJK_RE.match(token):
+            for i in range(len(token) - 1):
+                yield token[i : i + 2]
+        else:
+            yield token
+
+
+def encode_postings(doc_ids):
+    """Encode ascending doc IDs as varint deltas."""
+    out = bytearray()
+    prev = 0
+    for doc_id in doc_ids:
+        delta = doc_id - prev
+        prev = doc_id
+        while delta >= 0x80:
+            out.append(delta & 0x7F | 0x80)
+            delta >>= 7
+        out.append(delta)
+    return bytes(out)
+
+
+def decode_postings(data):
+    doc_ids = []
+    doc_id = delta = shift = 0
+    for byte in data:
+        delta |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            doc_id += delta
+            doc_ids.append(doc_id)
+            delta = shift = 0
+    return doc_ids
+
+
+def to_timestamp(date):
+    if date is None:
+        return None
+    if isinstance(date, str):
+        date = datetime.strptime(date, DATE_FORMAT)
+    return int(date.timestamp())
+
+
+class SearchIndex(object):
+    """Inverted index of posts in a SQLite file.
+
+    Each flush appends one postings segment per term, holding the doc IDs
+    added since the previous flush, so the index grows without rewriting
+    older postings. Doc IDs only ever increase; a post indexed again gets a
+    new doc ID and its old one is tombstoned until `compact` drops it.
+    """
+
+    def __init__(self, path: str) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(
+            "CREATE TABLE IF NOT EXISTS posts ("
+            "doc_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "url TEXT NOT NULL, "
+            "board TEXT, "
+            "date INTEGER, "
+            "score INTEGER, "
+            "title TEXT, "
+            "deleted INTEGER NOT NULL DEFAULT 0);"
+            "CREATE INDEX IF NOT EXISTS posts_url ON posts (url);"
+            "CREATE INDEX IF NOT EXISTS posts_date ON posts (date);"
+            "CREATE TABLE IF NOT EXISTS postings ("
+            "term TEXT NOT NULL, "
+            "segment INTEGER NOT NULL, "
+            "data BLOB NOT NULL, "
+            "PRIMARY KEY (term, segment)) WITHOUT ROWID;"
+            "CREATE TABLE IF NOT EXISTS sources (name TEXT PRIMARY KEY);"
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);"
+        )
+        self.version = self._version()
+        if self.version < INDEX_VERSION:
+            logger.warning(
+                "search index %s is version %d; rebuild it for faster single "
+                "character queries",
+                path,
+                self.version,
+            )
+        self._docs = []
+
+    def _version(self):
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = 'version'"
+        ).fetchone()
+        if row is not None:
+            return int(row[0])
+        # indexes written before the meta table are version 1
+        if self.conn.execute("SELECT 1 FROM posts LIMIT 1").fetchone() is not None:
+            version = 1
+        else:
+            version = INDEX_VERSION
+        self.conn.execute(
+            "INSERT INTO meta (key, value) VALUES ('version', ?)", (str(version),)
+        )
+        return version
+
+    def add(self, url, title, content, comments, date=None, score=None):
+        """Queue a post for indexing, replacing any earlier version of it."""
+        self._docs.append((url, title, content, comments, to_timestamp(date), score))
+
+    def __len__(self):
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM posts WHERE deleted = 0"
+        ).fetchone()[0]
+
+    def flush(self):
+        """Write the queued posts and their postings as a new segment."""
+        if not self._docs:
+            return 0
+        postings = defaultdict(list)
+        with self.conn:
+            self.conn.execute("BEGIN")
+            (segment,) = self.conn.execute(
+                "SELECT COALESCE(MAX(segment), 0) + 1 FROM postings"
+            ).fetchone()
+            for url, title, content, comments, date, score in self._docs:
+                self.conn.execute(
+                    "UPDATE posts SET deleted = 1 WHERE url = ? AND deleted = 0",
+                    (url,),
+                )
+                board, _ = parse_post_url(url)
+                doc_id = self.conn.execute(
+                    "INSERT INTO posts (url, board, date, score, title) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (url, board, date, score, title),
+                ).lastrowid
+                terms = set(tokenize(title or ""))
+                terms.update(tokenize(content or ""))
+                for comment in comments or ():
+                    terms.update(tokenize(comment))
+                for term in terms:
+                    postings[term].append(doc_id)
+            self.conn.executemany(
+                "INSERT INTO postings (term, segment, data) VALUES (?, ?, ?)",
+                (
+                    (term, segment, encode_postings(postings[term]))
+                    for term in sorted(postings)
+                ),
+            )
+        count = len(self._docs)
+        self._docs = []
+        return count
+
+    def has_source(self, name):
+        return (
+            self.conn.execute(
+                "SELECT 1 FROM sources WHERE name = ?", (name,)
+            ).fetchone()
+            is not None
+        )
+
+    def add_source(self, name):
+        self.conn.execute("INSERT OR IGNORE INTO sources (name) VALUES (?)", (name,))
+
+    def _postings(self, term):
+        doc_ids = []
+        for (data,) in self.conn.execute(
+            "SELECT data FROM postings WHERE term = ? ORDER BY segment", (term,)
+        ):
+            doc_ids.extend(decode_postings(data))
+        return doc_ids
+
+    def _is_scanned(self, term):
+        # version 1 indexes lack the postings of most single CJK characters
+        return self.version < 2 and len(term) == 1 and CJK_RE.match(term)
+
+    def _matches(self, term):
+        """Return the doc IDs of the posts containing `term`."""
+        if not self._is_scanned(term):
+            return set(self._postings(term))
+        # A single CJK character: itself and every bigram starting with it.
+        doc_ids = set()
+        for (data,) in self.conn.execute(
+            "SELECT data FROM postings WHERE term >= ? AND term < ?",
+            (term, chr(ord(term) + 1)),
+        ):
+            doc_ids.update(decode_postings(data))
+        return doc_ids
+
+    def search(
+        self, query, board=None, since=None, until=None, min_score=None, limit=20
+    ):
+        """Return the newest posts containing every term of `query`.
+
+        Results are dicts with doc_id, url, board, date, score and title.
+        """
+        terms = set(tokenize_query(query))
+        if not terms:
+            return []
+        # Intersect starting with the rarest terms; single characters that
+        # are scanned match the most posts and go last.
+        sizes = {
+            term: (
+                float("inf")
+                if self._is_scanned(term)
+                else self.conn.execute(
+                    "SELECT COALESCE(SUM(LENGTH(data)), 0) FROM postings WHERE term = ?",
+                    (term,),
+                ).fetchone()[0]
+            )
+            for term in terms
+        }
+        doc_ids = None
+        for term in sorted(terms, key=sizes.get):
+            matches = self._matches(term)
+            doc_ids = matches if doc_ids is None else doc_ids & matches
+            if not doc_ids:
+                return []
+
+        conditions = ["deleted = 0"]
+        params = []
+        if board is not None:
+            conditions.append("board = ?")
+            params.append(board)
+        if since is not None:
+            conditions.append("date >= ?")
+            params.append(to_timestamp(since))
+        if until is not None:
+            conditions.append("date < ?")
+            params.append(to_timestamp(until))
+        if min_score is not None:
+            conditions.append("score >= ?")
+            params.append(min_score)
+
+        columns = ", ".join(RESULT_FIELDS)
+        (max_doc_id,) = self.conn.execute("SELECT MAX(doc_id) FROM posts").fetchone()
+        if len(doc_ids) * DENSE_MATCHES >= (max_doc_id or 0):
+            # Many matches: the newest posts are likely to match, so walk them
+            # in date order until there are enough.
+            rows = self.conn.execute(
+                "SELECT {} FROM posts WHERE {} ORDER BY date DESC".format(
+                    columns, " AND ".join(conditions)
+                ),
+                params,
+            )
+            results = []
+            for row in rows:
+                if row[0] in doc_ids:
+                    results.append(dict(zip(RESULT_FIELDS, row)))
+                    if len(results) >= limit:
+                        break
+            rows.close()
+            return results
+
+        # Few matches: join them to the posts and let SQLite filter, sort and
+        # limit them. CROSS JOIN keeps SQLite from walking all the posts by
+        # date instead.
+        self.conn.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS matches (doc_id INTEGER PRIMARY KEY)"
+        )
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.execute("DELETE FROM matches")
+            self.conn.executemany(
+                "INSERT INTO matches (doc_id) VALUES (?)",
+                ((doc_id,) for doc_id in sorted(doc_ids)),
+            )
+        rows = self.conn.execute(
+            "SELECT {} FROM matches CROSS JOIN posts USING (doc_id) WHERE {} "
+            "ORDER BY date DESC LIMIT ?".format(columns, " AND ".join(conditions)),
+            params + [limit],
+        )
+        return [dict(zip(RESULT_FIELDS, row)) for row in rows]
+
+    def compact(self):
+        """Merge the segments of every term and drop tombstoned posts."""
+        deleted = {
+            doc_id
+            for (doc_id,) in self.conn.execute(
+                "SELECT doc_id FROM posts WHERE deleted = 1"
+            )
+        }
+        terms = [
+            term for (term,) in self.conn.execute("SELECT DISTINCT term FROM postings")
+        ]
+        with self.conn:
+            self.conn.execute("BEGIN")
+            for term in terms:
+                doc_ids = [
+                    doc_id for doc_id in self._postings(term) if doc_id not in deleted
+                ]
+                self.conn.execute("DELETE FROM postings WHERE term = ?", (term,))
+                if doc_ids:
+                    self.conn.execute(
+                        "INSERT INTO postings (term, segment, data) VALUES (?, 0, ?)",
+                        (term, encode_postings(doc_ids)),
+                    )
+            self.conn.execute("DELETE FROM posts WHERE deleted = 1")
+        self.conn.execute("VACUUM")
+        return len(deleted)
+
+    def close(self):
+        self.flush()
+        self.conn.close()
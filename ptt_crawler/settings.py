@@ -20,7 +20,7 @@ NEWSPIDER_MODULE = 'ptt_crawler.spiders'
 ROBOTSTXT_OBEY = True
 
 # Configure maximum concurrent requests performed by Scrapy (default: 16)
-#CONCURRENT_REQUESTS = 32
+CONCURRENT_REQUESTS = 32
 
 # Configure a delay for requests for the same website (default: 0)
 # See https://docs.scrapy.org/en/latest/topics/settings.html#download-delay
@@ -44,28 +44,89 @@ ROBOTSTXT_OBEY = True
 
 # Enable or disable spider middlewares
 # See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
-#SPIDER_MIDDLEWARES = {
-#    'ptt_crawler.middlewares.PttCrawlerSpiderMiddleware': 543,
-#}
+SPIDER_MIDDLEWARES = {
+    'ptt_crawler.frontier.FrontierMiddleware': 40,
+    'ptt_crawler.middlewares.PttProfilingSpiderMiddleware': 950,
+}
+
+# Share index pages and posts between several workers through a frontier
+# at sqlite:///path or redis://host:port/db (disabled unless FRONTIER_URI is
+# set). Leases that are not done within FRONTIER_LEASE_SECS are handed out
+# again, up to FRONTIER_MAX_ATTEMPTS times
+#FRONTIER_URI = 'sqlite:///frontier.sqlite'
+#FRONTIER_NAME = 'posts'
+#FRONTIER_BATCH_SIZE = 32
+#FRONTIER_LEASE_SECS = 300
+#FRONTIER_MAX_ATTEMPTS = 3
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
-#DOWNLOADER_MIDDLEWARES = {
-#    'ptt_crawler.middlewares.PttCrawlerDownloaderMiddleware': 543,
+DOWNLOADER_MIDDLEWARES = {
+    'ptt_crawler.middlewares.PttThrottleMiddleware': 650,
+}
+
+# Delay and concurrency of each throttled domain, which PttThrottleMiddleware
+# adjusts between their bounds to keep latency under target_latency seconds
+#PTT_THROTTLE_DOMAINS = {
+#    'ptt.cc': {'start_delay': 1.0, 'min_delay': 0.25, 'max_delay': 60.0,
+#               'start_concurrency': 1, 'max_concurrency': 4,
+#               'target_latency': 1.0},
+#    'imgur.com': {'start_delay': 0.0, 'min_delay': 0.0, 'max_delay': 30.0,
+#                  'start_concurrency': 8, 'max_concurrency': 32,
+#                  'target_latency': 2.0},
 #}
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
-#EXTENSIONS = {
-#    'scrapy.extensions.telnet.TelnetConsole': None,
-#}
+EXTENSIONS = {
+    'ptt_crawler.profiling.ProfilingExtension': 500,
+}
+
+# Latency histograms of downloads, callbacks, encryption and uploads, kept
+# in the stats and written every PROFILING_INTERVAL seconds to
+# PROFILING_METRICS_FILE. SIGUSR2 profiles the callbacks with cProfile for
+# PROFILING_SNAPSHOT_SECS into PROFILING_DIR
+#PROFILING_ENABLED = False
+#PROFILING_METRICS_FILE = 'metrics.jsonl'
+#PROFILING_INTERVAL = 60
+#PROFILING_DIR = 'profiles'
+#PROFILING_SNAPSHOT_SECS = 30
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
+    'ptt_crawler.pipelines.ImageDedupPipeline': 200,
     'ptt_crawler.pipelines.EncryptedFilesPipeline': 300,
+    'ptt_crawler.pipelines.ParquetExportPipeline': 400,
+    'ptt_crawler.pipelines.SearchIndexPipeline': 500,
 }
 
+# Format of the `content` of posts: 'html2text' converts the whole post,
+# metalines and pushes included, to markdown as exports always did; 'text'
+# is only the body text as on the page, several times faster to parse
+#POSTS_CONTENT_FORMAT = 'html2text'
+
+# Hosts whose image links are downloaded; direct image links are kept as
+# they are, other imgur links are resolved to the direct full size image
+#IMAGE_HOSTS = ['imgur.com']
+
+# Skip images already stored by earlier runs, keyed by canonical image ID
+# in a Bloom filter (disabled unless IMAGE_DEDUP_FILTER is set)
+#IMAGE_DEDUP_FILTER = 'images.bloom'
+#IMAGE_DEDUP_CAPACITY = 10000000
+#IMAGE_DEDUP_ERROR_RATE = 1e-4
+
+# Full-text index of titles, contents and comments, searchable with
+# bin/search_posts.py (disabled unless SEARCH_INDEX_PATH is set)
+#SEARCH_INDEX_PATH = 'search.sqlite'
+#SEARCH_INDEX_BATCH_SIZE = 1000
+
+# Write posts and comments to Parquet files partitioned by board and month
+# (disabled unless PARQUET_EXPORT_DIR is set)
+#PARQUET_EXPORT_DIR = 'parquet'
+#PARQUET_ROW_GROUP_SIZE = 1000
+#PARQUET_MAX_FILE_SIZE = 128 * 1024 * 1024
+
 FILES_STORES = {
     '': 'scrapy.pipelines.files.FSFilesStore',
     'file': 'scrapy.pipelines.files.FSFilesStore',
@@ -73,9 +134,44 @@ FILES_STORES = {
     'b2': 'ptt_crawler.pipelines.B2FilesStore',
 }
 
+# Connection pool and multipart transfer settings of the shared B2 client
+#B2_MAX_POOL_CONNECTIONS = 20
+#B2_MULTIPART_THRESHOLD = 16 * 1024 * 1024
+#B2_MULTIPART_CHUNKSIZE = 16 * 1024 * 1024
+#B2_MAX_CONCURRENCY = 4
+
+# Local SQLite index of files uploaded to B2, so that files already in the
+# bucket are not downloaded again. Misses fall back to a HEAD request unless
+# B2_FILES_HEAD_FALLBACK is False. Rebuild it with bin/rebuild_files_index.py
+#B2_FILES_INDEX = 'b2files.sqlite'
+#B2_FILES_HEAD_FALLBACK = True
+
+# Bound the uploads of downloaded files: concurrent uploads, files being
+# downloaded or waiting to be uploaded before more downloads are held back,
+# and retries with exponential backoff starting at FILES_UPLOAD_BACKOFF seconds
+#FILES_UPLOAD_CONCURRENCY = 4
+#FILES_UPLOAD_QUEUE_SIZE = 16
+#FILES_UPLOAD_RETRIES = 3
+#FILES_UPLOAD_BACKOFF = 1.0
+
+# Encrypted files over FILES_ENCRYPTION_SPOOL_SIZE bytes wait for their
+# upload in a temporary file instead of in memory
+#FILES_ENCRYPTION_SPOOL_SIZE = 1024 * 1024
+
+# Schedule of `-a refresh=1` runs, which revisit posts recorded in the
+# state_file: a post gaining pushes is due again after about
+# POSTS_REFRESH_TARGET_PUSHES more pushes at its current rate, a quiet one
+# backs off, and posts older than POSTS_REFRESH_MAX_AGE seconds are dropped
+# from the state_file whenever it is saved
+#POSTS_REFRESH_MIN_INTERVAL = 600
+#POSTS_REFRESH_MAX_INTERVAL = 24 * 3600
+#POSTS_REFRESH_TARGET_PUSHES = 10
+#POSTS_REFRESH_MAX_AGE = 7 * 24 * 3600
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
-AUTOTHROTTLE_ENABLED = True
+# Disabled in favour of the per-domain PttThrottleMiddleware
+AUTOTHROTTLE_ENABLED = False
 # The initial download delay
 AUTOTHROTTLE_START_DELAY = 5
 # The maximum download delay to be set in case of high latencies
@@ -92,4 +188,11 @@ AUTOTHROTTLE_TARGET_CONCURRENCY = 1.0
 #HTTPCACHE_EXPIRATION_SECS = 0
 #HTTPCACHE_DIR = 'httpcache'
 #HTTPCACHE_IGNORE_HTTP_CODES = []
-#HTTPCACHE_STORAGE = 'scrapy.extensions.httpcache.FilesystemCacheStorage'
+HTTPCACHE_STORAGE = 'ptt_crawler.httpcache.SqliteCacheStorage'
+HTTPCACHE_POLICY = 'ptt_crawler.httpcache.PttCachePolicy'
+# Compressed responses are evicted least recently used first past this size
+#HTTPCACHE_SQLITE_MAX_SIZE = 1024 ** 3
+#HTTPCACHE_SQLITE_COMPRESSION = 6
+# Serve every cached page without revalidation, e.g. to replay a crawl
+# offline together with HTTPCACHE_IGNORE_MISSING = True
+#HTTPCACHE_OFFLINE = False
@@ -1,100 +1,380 @@
+import re
+import time
+from collections import Counter
 from datetime import datetime
+from urllib.parse import urlparse
 
-import html2text
 import scrapy
 
+from ptt_crawler.extractors import extract_post
+from ptt_crawler.extractors import html2text_content
+from ptt_crawler.images import DEFAULT_IMAGE_HOSTS
+from ptt_crawler.images import extract_image_urls
+from ptt_crawler.items import PostDeltaItem
 from ptt_crawler.items import PostItem
+from ptt_crawler.state import CrawlState
+from ptt_crawler.utils import article_id_key
+from ptt_crawler.utils import get_board_name
+from ptt_crawler.utils import parse_post_url
 
-BOARD_URL_FORMAT = "http://ptt.cc/bbs/{board_name}/index.html"
+BASE_URL = "http://ptt.cc"
+BOARD_URL_FORMAT = "{base_url}/bbs/{board_name}/index.html"
+INDEX_URL_FORMAT = "{base_url}/bbs/{board_name}/index{index}.html"
+INDEX_URL_RE = re.compile(r"/index(\d+)\.html")
+CONTENT_FORMATS = ("html2text", "text")
+
+
+def parse_page_range(pages: str):
+    """Parse a page range such as "3900-3950" or "3900" into (first, last)."""
+    first, _, last = pages.partition("-")
+    first = int(first)
+    last = int(last) if last else first
+    if first > last:
+        first, last = last, first
+    return first, last
+
+
+def parse_bool(value: str):
+    """Parse a spider argument such as "1", "true", "0" or "false"."""
+    value = value.strip().lower()
+    if value in ("1", "true", "yes", "on"):
+        return True
+    if value in ("", "0", "false", "no", "off"):
+        return False
+    raise ValueError("{!r} is not a boolean".format(value))
+
+
+def parse_board_values(boards: str):
+    """Parse "Gossiping:3,C_Chat" into {"Gossiping": 3, "C_Chat": None}."""
+    values = {}
+    for spec in boards.split(","):
+        board_name, _, value = spec.partition(":")
+        values[board_name] = int(value) if value else None
+    return values
+
+
+def next_refresh_interval(
+    interval, new_pushes, elapsed, min_interval, max_interval, target_pushes
+):
+    """Return the delay in seconds until a post is due for another refresh.
+
+    A post gaining pushes is revisited about every `target_pushes` pushes at
+    its current velocity; a quiet one backs off exponentially.
+    """
+    if new_pushes > 0 and elapsed > 0:
+        interval = target_pushes * elapsed / new_pushes
+    else:
+        interval *= 2
+    return min(max(interval, min_interval), max_interval)
 
 
 class PostsSpider(scrapy.Spider):
     name = "posts"
     allowed_domains = ["ptt.cc"]
     start_urls = ["http://ptt.cc/bbs/PC_Shopping/index.html"]
+    # see POSTS_CONTENT_FORMAT in settings.py
+    content_format = "html2text"
+    # see IMAGE_HOSTS in settings.py
+    image_hosts = DEFAULT_IMAGE_HOSTS
 
-    def __init__(self, *args, board_names: str = None, max_pages: str = "5", **kwargs):
+    def __init__(
+        self,
+        *args,
+        board_names: str = None,
+        max_pages: str = "5",
+        board_max_pages: str = None,
+        pages: str = None,
+        state_file: str = None,
+        refresh: str = None,
+        base_url: str = None,
+        **kwargs
+    ):
         super().__init__(*args, **kwargs)
+        # Another site serving PTT's pages, such as the mock server of
+        # bin/loadtest.py.
+        self._base_url = (base_url or BASE_URL).rstrip("/")
+        if base_url is not None:
+            self.allowed_domains = [urlparse(self._base_url).hostname]
+            self.start_urls = [
+                BOARD_URL_FORMAT.format(
+                    base_url=self._base_url, board_name="PC_Shopping"
+                )
+            ]
+        # Boards may be given a weight, as in "Gossiping:3,C_Chat", to get a
+        # larger share of the requests than the others.
+        self._weights = {}
         if board_names is not None:
+            self._weights = parse_board_values(board_names)
             self.start_urls = [
-                BOARD_URL_FORMAT.format(board_name=board_name)
-                for board_name in board_names.split(",")
+                BOARD_URL_FORMAT.format(base_url=self._base_url, board_name=board_name)
+                for board_name in self._weights
             ]
         self._max_pages = int(max_pages)
-        self._pages = 0
+        self._board_max_pages = (
+            parse_board_values(board_max_pages) if board_max_pages else {}
+        )
+        self._scheduled = Counter()
+        self._page_range = parse_page_range(pages) if pages is not None else None
+        self._state = CrawlState(state_file) if state_file is not None else None
+        self._refresh = refresh is not None and parse_bool(refresh)
+        if self._refresh and self._state is None:
+            raise ValueError("refresh requires a state_file")
 
-    def parse(self, response):
-        self._pages += 1
-        for href in response.css(".r-ent > div.title > a::attr(href)"):
-            url = response.urljoin(href.extract())
-            yield scrapy.Request(url, callback=self.parse_post)
-
-        if self._pages < self._max_pages:
-            next_page = response.xpath(
-                '//div[@id="action-bar-container"]//a[contains(text(), "上頁")]/@href'
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.content_format = crawler.settings.get(
+            "POSTS_CONTENT_FORMAT", spider.content_format
+        )
+        if spider.content_format not in CONTENT_FORMATS:
+            raise ValueError(
+                "POSTS_CONTENT_FORMAT must be one of {}".format(CONTENT_FORMATS)
             )
-            if next_page:
-                url = response.urljoin(next_page[0].extract())
-                self.logger.warning("follow {}".format(url))
-                yield scrapy.Request(url, self.parse)
-            else:
-                self.logger.warning("no next page")
-        else:
-            self.logger.warning("max pages reached")
+        spider.image_hosts = crawler.settings.getlist("IMAGE_HOSTS", spider.image_hosts)
+        if spider._state is not None:
+            spider._state.max_age = crawler.settings.getfloat(
+                "POSTS_REFRESH_MAX_AGE", 7 * 24 * 3600
+            )
+        return spider
 
-    def parse_post(self, response):
-        item = PostItem()
-        item["title"] = response.xpath('//meta[@property="og:title"]/@content')[
-            0
-        ].extract()
-        item["author"] = (
-            response.xpath(
-                '//div[@class="article-metaline"]/span[text()="作者"]/following-sibling::span[1]/text()'
-            )[0]
-            .extract()
-            .split(" ")[0]
+    def closed(self, reason):
+        if self._state is not None and reason == "finished":
+            self._state.save()
+
+        stats = self.crawler.stats
+        for board_name in sorted(self._scheduled):
+            self.logger.info(
+                "board {}: {} index pages, {} posts, {} items".format(
+                    board_name,
+                    stats.get_value("boards/{}/index_pages".format(board_name), 0),
+                    stats.get_value("boards/{}/posts".format(board_name), 0),
+                    stats.get_value("boards/{}/items".format(board_name), 0),
+                )
+            )
+
+    def _priority(self, board_name):
+        """Return the priority of the next request of a board.
+
+        Each priority level takes `weight` requests from every board, so the
+        scheduler serves boards round-robin in proportion to their weights,
+        and requests made earlier, i.e. newer pages and posts, go first.
+        """
+        weight = self._weights.get(board_name) or 1
+        priority = -(self._scheduled[board_name] // weight)
+        self._scheduled[board_name] += 1
+        return priority
+
+    def _inc_board_stats(self, board_name, key):
+        self.crawler.stats.inc_value("boards/{}/{}".format(board_name, key))
+
+    def start_requests(self):
+        if self._refresh:
+            yield from self.refresh_requests()
+            return
+
+        if self._page_range is None:
+            yield from super().start_requests()
+            return
+
+        first, last = self._page_range
+        if self._state is not None:
+            self.logger.warning(
+                "backfill pages {}-{}: crawled posts are not skipped".format(
+                    first, last
+                )
+            )
+        for url in self.start_urls:
+            board_name = get_board_name(url)
+            for index in range(last, first - 1, -1):
+                yield scrapy.Request(
+                    INDEX_URL_FORMAT.format(
+                        base_url=self._base_url, board_name=board_name, index=index
+                    ),
+                    callback=self.parse_index,
+                    priority=self._priority(board_name),
+                )
+
+    def refresh_requests(self):
+        """Revisit the crawled posts that are due, dropping expired ones."""
+        now = time.time()
+        self._state.prune(self._state.max_age, now)
+        due = [
+            (url, post)
+            for url, post in self._state.posts.items()
+            if now >= post["crawled"] + post["interval"]
+        ]
+        self.logger.warning(
+            "refresh {} of {} posts".format(len(due), len(self._state.posts))
         )
-        datetime_str = response.xpath(
-            '//div[@class="article-metaline"]/span[text()="時間"]/following-sibling::span[1]/text()'
-        )[0].extract()
-        item["date"] = datetime.strptime(datetime_str, "%a %b %d %H:%M:%S %Y")
-
-        converter = html2text.HTML2Text()
-        converter.ignore_links = True
-        item["content"] = converter.handle(
-            response.xpath('//div[@id="main-content"]')[0].extract()
+
+        for url, post in due:
+            headers = {}
+            if post.get("etag"):
+                headers["If-None-Match"] = post["etag"]
+            if post.get("last_modified"):
+                headers["If-Modified-Since"] = post["last_modified"]
+            yield scrapy.Request(
+                url,
+                callback=self.parse_refresh,
+                headers=headers,
+                meta={
+                    "handle_httpstatus_list": [304],
+                    "ptt_refresh": True,
+                    "ptt_post_url": url,
+                },
+                dont_filter=True,
+            )
+
+    def parse(self, response):
+        """Parse the newest index page and fan out to the older ones at once."""
+        board_name = get_board_name(response.url)
+        prev_page = response.xpath(
+            '//div[@id="action-bar-container"]//a[contains(text(), "上頁")]/@href'
+        ).get()
+        m = INDEX_URL_RE.search(prev_page) if prev_page else None
+        last_index = int(m.group(1)) + 1 if m else 1
+
+        max_pages = self._board_max_pages.get(board_name) or self._max_pages
+        first_index = max(last_index - max_pages + 1, 1)
+        if self._state is not None:
+            stored_index = self._state.get_last_index(board_name)
+            if stored_index is not None and stored_index > first_index:
+                first_index = stored_index
+            self._state.update_index(board_name, last_index)
+
+        self.logger.warning(
+            "crawl {} pages {}-{}".format(board_name, first_index, last_index)
         )
+        yield from self.parse_index(response)
+        for index in range(last_index - 1, first_index - 1, -1):
+            yield scrapy.Request(
+                INDEX_URL_FORMAT.format(
+                    base_url=self._base_url, board_name=board_name, index=index
+                ),
+                callback=self.parse_index,
+                priority=self._priority(board_name),
+            )
 
-        comments = []
-        total_score = 0
-        for comment in response.xpath('//div[@class="push"]'):
-            push_tag = comment.css("span.push-tag::text")[0].extract()
-            push_user = comment.css("span.push-userid::text")[0].extract()
-            push_content = comment.css("span.push-content::text")[0].extract()
+    def parse_index(self, response):
+        board_name = get_board_name(response.url)
+        self._inc_board_stats(board_name, "index_pages")
+        # An explicit page range is a backfill: crawl every post on it, and
+        # leave the incremental mark alone.
+        track = self._state is not None and self._page_range is None
+        last_article_id = None
+        if track:
+            last_article_id = self._state.get_last_article_id(board_name)
 
-            if "推" in push_tag:
-                score = 1
-            elif "噓" in push_tag:
-                score = -1
-            else:
-                score = 0
+        # Entries are listed oldest first; request the newest posts first.
+        for entry in reversed(response.css(".r-ent")):
+            href = entry.css("div.title > a::attr(href)").get()
+            if href is None:
+                continue
+            url = response.urljoin(href)
 
-            total_score += score
+            _, article_id = parse_post_url(url)
+            if last_article_id is not None and article_id is not None:
+                if article_id_key(article_id) <= article_id_key(last_article_id):
+                    continue
+            if track and article_id is not None:
+                self._state.update_board(board_name, article_id)
 
-            comments.append(
-                {"user": push_user, "content": push_content, "score": score}
+            self._inc_board_stats(board_name, "posts")
+            yield scrapy.Request(
+                url, callback=self.parse_post, priority=self._priority(board_name)
             )
 
-        item["comments"] = comments
-        item["score"] = total_score
+    def parse_post(self, response):
+        post = extract_post(response.selector.root)
+
+        item = PostItem()
+        item["title"] = post["title"]
+        item["author"] = post["metalines"]["作者"].split(" ")[0]
+        item["date"] = datetime.strptime(
+            post["metalines"]["時間"], "%a %b %d %H:%M:%S %Y"
+        )
+        if self.content_format == "text":
+            item["content"] = post["content"]
+        else:
+            item["content"] = html2text_content(response.selector.root)
+        item["comments"] = post["comments"]
+        item["score"] = sum(post["comments"]["score"])
         item["url"] = response.url
 
-        file_urls = response.xpath('//a[contains(@href, "imgur.com")]/@href').extract()
-        if file_urls:
-            file_urls = [
-                url for url in file_urls if url.endswith(".jpg") or url.endswith(".png")
-            ]
+        file_urls = extract_image_urls(post["links"], self.image_hosts)
         if file_urls:
             item["file_urls"] = file_urls
 
+            if self._state is not None:
+                self._record_post(
+                    response.url,
+                    response,
+                    len(post["comments"]["score"]),
+                    item["date"].timestamp(),
+                )
+            self._inc_board_stats(get_board_name(response.url), "items")
             yield item
+
+    def parse_refresh(self, response):
+        """Emit the pushes appended to a post since it was last crawled."""
+        # the post is recorded under the requested URL, which a redirect,
+        # e.g. to the over18 page, changes
+        url = response.meta["ptt_post_url"]
+        if parse_post_url(response.url)[1] != parse_post_url(url)[1]:
+            self.logger.warning(
+                "refresh of {} redirected to {}, skipped".format(url, response.url)
+            )
+            self.crawler.stats.inc_value("refresh/redirected")
+            return
+
+        known = self._state.get_post(url)["pushes"]
+        if response.status == 304:
+            self.crawler.stats.inc_value("refresh/not_modified")
+            self._record_post(url, response, known)
+            return
+
+        comments = extract_post(response.selector.root)["comments"]
+        pushes = len(comments["score"])
+        self._record_post(url, response, pushes)
+        # Fewer pushes than before means some were deleted, so the positions
+        # seen so far no longer hold and all of them are sent again.
+        offset = known if known <= pushes else 0
+        if offset == pushes:
+            self.crawler.stats.inc_value("refresh/unchanged")
+            return
+
+        self.crawler.stats.inc_value("refresh/new_pushes", pushes - offset)
+        item = PostDeltaItem()
+        item["url"] = url
+        item["score"] = sum(comments["score"])
+        item["push_offset"] = offset
+        item["comments"] = {
+            field: values[offset:] for field, values in comments.items()
+        }
+        yield item
+
+    def _record_post(self, url, response, pushes, date=None):
+        settings = self.settings
+        min_interval = settings.getfloat("POSTS_REFRESH_MIN_INTERVAL", 600)
+        now = time.time()
+        fields = {"crawled": now, "pushes": pushes}
+
+        previous = self._state.get_post(url)
+        if previous is None:
+            fields["interval"] = min_interval
+        else:
+            fields["interval"] = next_refresh_interval(
+                previous["interval"],
+                pushes - previous["pushes"],
+                now - previous["crawled"],
+                min_interval,
+                settings.getfloat("POSTS_REFRESH_MAX_INTERVAL", 24 * 3600),
+                settings.getint("POSTS_REFRESH_TARGET_PUSHES", 10),
+            )
+        if date is not None:
+            fields["date"] = date
+        for field, header in (("etag", b"ETag"), ("last_modified", b"Last-Modified")):
+            value = response.headers.get(header)
+            if value:
+                fields[field] = value.decode("latin1")
+        self._state.update_post(url, **fields)
@@ -0,0 +1,91 @@
+import json
+import logging
+import os
+import time
+
+from ptt_crawler.utils import article_id_key
+
+logger = logging.getLogger(__name__)
+
+
+class CrawlState(object):
+    """Per-board crawl progress persisted to a local JSON file.
+
+    Board updates made during a run only become visible after `save`, so the
+    marks read while crawling are always the ones left by the previous run.
+    Crawled posts are tracked per URL for refreshing their pushes, and
+    those older than `max_age` seconds are dropped on `save`.
+    """
+
+    def __init__(self, path: str, max_age: float = None) -> None:
+        self.path = path
+        self.max_age = max_age
+        self.boards = {}
+        self.posts = {}
+        self._updates = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf8") as infile:
+                state = json.load(infile)
+            self.boards = state.get("boards", {})
+            self.posts = state.get("posts", {})
+            logger.info(
+                "loaded crawl state for %d boards and %d posts",
+                len(self.boards),
+                len(self.posts),
+            )
+
+    def get_last_article_id(self, board_name):
+        return self.boards.get(board_name, {}).get("article_id")
+
+    def get_last_index(self, board_name):
+        return self.boards.get(board_name, {}).get("index")
+
+    def update_board(self, board_name, article_id):
+        updates = self._updates.setdefault(board_name, {})
+        last_article_id = updates.get(
+            "article_id", self.get_last_article_id(board_name)
+        )
+        if last_article_id is None or article_id_key(article_id) > article_id_key(
+            last_article_id
+        ):
+            updates["article_id"] = article_id
+
+    def update_index(self, board_name, index):
+        self._updates.setdefault(board_name, {})["index"] = index
+
+    def get_post(self, url):
+        return self.posts.get(url)
+
+    def update_post(self, url, **fields):
+        self.posts.setdefault(url, {}).update(fields)
+
+    def prune(self, max_age, now=None):
+        """Drop the posts dated more than `max_age` seconds before `now`."""
+        if now is None:
+            now = time.time()
+        expired = [
+            url for url, post in self.posts.items() if now - post["date"] > max_age
+        ]
+        for url in expired:
+            del self.posts[url]
+        return len(expired)
+
+    def save(self):
+        if self.max_age is not None:
+            self.prune(self.max_age)
+        for board_name, updates in self._updates.items():
+            self.boards.setdefault(board_name, {}).update(updates)
+        self._updates = {}
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf8") as outfile:
+            json.dump(
+                {"boards": self.boards, "posts": self.posts},
+                outfile,
+                ensure_ascii=False,
+                indent=2,
+            )
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,124 @@
+import logging
+import os
+import time
+
+from twisted.internet import defer, task
+
+logger = logging.getLogger(__name__)
+
+
+class UploadScheduler(object):
+    """Bounded, retrying scheduler for the uploads of a files store.
+
+    Callers `enter` before downloading a file and `leave` once its upload
+    is done or its download failed, so at most `queue_size` files are being
+    downloaded, encrypted or uploaded; further callers wait before their
+    requests are scheduled, which keeps their items in the scraper and
+    throttles the crawl. At most `concurrency` uploads run at a time.
+    """
+
+    def __init__(
+        self,
+        store,
+        concurrency: int = 4,
+        queue_size: int = 16,
+        retries: int = 3,
+        backoff: float = 1.0,
+        stats=None,
+    ) -> None:
+        self.store = store
+        self.retries = retries
+        self.backoff = backoff
+        self.stats = stats
+        self._queue = defer.DeferredSemaphore(max(queue_size, concurrency))
+        self._slots = defer.DeferredSemaphore(concurrency)
+        self._pending = set()
+        self._depth = 0
+        self._bytes = 0
+        self._started = None
+
+    def _inc_stats(self, key, count=1):
+        if self.stats is not None:
+            self.stats.inc_value("file_upload/{}".format(key), count)
+
+    def enter(self):
+        """Return a Deferred that fires once there is room in the queue."""
+        dfd = self._queue.acquire()
+
+        def _entered(result):
+            self._depth += 1
+            if self.stats is not None:
+                self.stats.max_value("file_upload/queue_depth_max", self._depth)
+            return result
+
+        return dfd.addCallback(_entered)
+
+    def leave(self, result=None):
+        """Free the queue room taken by `enter`; passes `result` through."""
+        self._depth -= 1
+        self._queue.release()
+        return result
+
+    def upload(self, path, buf, info, meta=None):
+        """Upload `buf` to the store, retrying with exponential backoff."""
+        if self._started is None:
+            self._started = time.monotonic()
+        buf.seek(0, os.SEEK_END)
+        size = buf.tell()
+        buf.seek(0)
+
+        def _uploaded(result):
+            self._bytes += size
+            self._inc_stats("count")
+            self._inc_stats("bytes", size)
+            return result
+
+        def _failed(failure):
+            self._inc_stats("failures")
+            return failure
+
+        dfd = self._attempt(0, path, buf, info, meta)
+        dfd.addCallbacks(_uploaded, _failed)
+        self._pending.add(dfd)
+        dfd.addBoth(self._forget, dfd)
+        return dfd
+
+    def _forget(self, result, dfd):
+        self._pending.discard(dfd)
+        return result
+
+    def _attempt(self, attempt, path, buf, info, meta):
+        from twisted.internet import reactor
+
+        def _retry(failure):
+            if attempt >= self.retries:
+                return failure
+            delay = self.backoff * 2**attempt
+            logger.warning(
+                "Upload of %(path)s failed (%(error)s), retrying in %(delay).1fs",
+                {"path": path, "error": failure.value, "delay": delay},
+                extra={"spider": info.spider},
+            )
+            self._inc_stats("retries")
+            return task.deferLater(
+                reactor, delay, self._attempt, attempt + 1, path, buf, info, meta
+            )
+
+        # the upload slot is freed during the backoff, so that failing
+        # uploads do not hold up the others
+        dfd = self._slots.run(self.store.persist_file, path, buf, info, meta=meta)
+        return dfd.addErrback(_retry)
+
+    def drain(self):
+        """Return a Deferred that fires once all running uploads are done."""
+        dfd = defer.DeferredList(list(self._pending), consumeErrors=True)
+
+        def _drained(_):
+            if self.stats is not None and self._started is not None:
+                elapsed = time.monotonic() - self._started
+                if elapsed > 0:
+                    self.stats.set_value(
+                        "file_upload/bytes_per_second", self._bytes / elapsed
+                    )
+
+        return dfd.addCallback(_drained)
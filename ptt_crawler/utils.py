@@ -1,9 +1,18 @@
+import gzip
+import io
 import json
 import os
-from io import BytesIO
+import re
+import zlib
 
 from scrapy.utils.project import get_project_settings
 
+from ptt_crawler.b2 import get_b2_client
+
+BOARD_URL_RE = re.compile(r"/bbs/([^/]+)/")
+POST_URL_RE = re.compile(r"/bbs/([^/]+)/(M\.\d+\.A\.[0-9A-Fa-f]*)\.html")
+ITEMS_EXTENSIONS = (".jl", ".jl.gz")
+
 
 def get_shub_project_settings():
     settings = get_project_settings()
@@ -16,8 +25,99 @@ def split_bucket_prefix(uri):
     return uri[5:].split("/", 1)
 
 
-def upload_file(bucket, file_name, content):
-    with BytesIO() as source:
-        source.write(content)
-        source.seek(0)
-        bucket.upload_fileobj(source, file_name)
+def natural_key(name):
+    """Sort key that orders job exports such as 123-1-9 before 123-1-10."""
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", name)]
+
+
+def list_item_sources(paths, b2_args):
+    """Yield the item exports in files, directories or b2://bucket/prefix.
+
+    Exports found in a directory or under a prefix are yielded in job order.
+    """
+    for path in paths:
+        if path.startswith("b2://"):
+            b2 = get_b2_client(*b2_args)
+            bucket_name, *prefix = split_bucket_prefix(path)
+            paginator = b2.get_paginator("list_objects_v2")
+            pages = paginator.paginate(
+                Bucket=bucket_name, Prefix=prefix[0] if prefix else ""
+            )
+            keys = [
+                obj["Key"]
+                for page in pages
+                for obj in page.get("Contents", [])
+                if obj["Key"].endswith(ITEMS_EXTENSIONS)
+            ]
+            for key in sorted(keys, key=natural_key):
+                yield "b2://{}/{}".format(bucket_name, key)
+        elif os.path.isdir(path):
+            sources = [
+                os.path.join(dirpath, name)
+                for dirpath, _, filenames in os.walk(path)
+                for name in filenames
+                if name.endswith(ITEMS_EXTENSIONS)
+            ]
+            yield from sorted(sources, key=natural_key)
+        else:
+            yield path
+
+
+def read_item_source(source, b2_args):
+    """Yield the items of a .jl or .jl.gz export, local or on B2."""
+    if source.startswith("b2://"):
+        bucket_name, key = split_bucket_prefix(source)
+        infile = get_b2_client(*b2_args).get_object(Bucket=bucket_name, Key=key)["Body"]
+    else:
+        infile = open(source, "rb")
+    with infile:
+        if source.endswith(".gz"):
+            infile = gzip.GzipFile(fileobj=infile)
+        for line in infile:
+            yield json.loads(line)
+
+
+class GzipJsonLinesStream(io.RawIOBase):
+    """Readable stream of items as gzipped JSON lines, compressed on read."""
+
+    def __init__(self, items) -> None:
+        self._items = iter(items)
+        self._compressor = zlib.compressobj(wbits=31)
+        self._buffer = bytearray()
+        self._done = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        # fill `b` completely unless the items run out, since uploaders
+        # take a short read as the end of a part
+        while len(self._buffer) < len(b) and not self._done:
+            item = next(self._items, None)
+            if item is None:
+                self._buffer += self._compressor.flush()
+                self._done = True
+            else:
+                line = json.dumps(item) + "\n"
+                self._buffer += self._compressor.compress(line.encode("utf8"))
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        del self._buffer[:size]
+        return size
+
+
+def get_board_name(url):
+    m = BOARD_URL_RE.search(url)
+    return m.group(1) if m else None
+
+
+def parse_post_url(url):
+    """Return (board_name, article_id) of a post URL, or (None, None)."""
+    m = POST_URL_RE.search(url)
+    return m.groups() if m else (None, None)
+
+
+def article_id_key(article_id):
+    """Sort key of article IDs such as M.1700000000.A.1F3, oldest first."""
+    _, timestamp, _, suffix = article_id.split(".", 3)
+    return int(timestamp), int(suffix or "0", 16)
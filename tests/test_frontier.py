@@ -0,0 +1,119 @@
+import json
+
+import pytest
+import scrapy
+from scrapy.http import Response
+from scrapy.spidermiddlewares.httperror import HttpError
+from scrapy.utils.test import get_crawler
+from twisted.internet.error import TimeoutError
+from twisted.python.failure import Failure
+
+from ptt_crawler.frontier import FrontierMiddleware, RedisFrontier, SqliteFrontier
+
+
+def entry(url, priority=0, revisit=False):
+    request = json.dumps({"url": url, "callback": "parse", "priority": priority})
+    return url, request, priority, revisit
+
+
+def leased_urls(frontier, count=10, ttl=60):
+    return [json.loads(request)["url"] for request in frontier.lease(count, ttl)]
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def frontier(request, tmp_path, monkeypatch):
+    if request.param == "sqlite":
+        frontier = SqliteFrontier(str(tmp_path / "frontier.sqlite"), "posts")
+    else:
+        fakeredis = pytest.importorskip("fakeredis")
+        import redis
+
+        server = fakeredis.FakeServer()
+        monkeypatch.setattr(
+            redis.Redis,
+            "from_url",
+            lambda url: fakeredis.FakeRedis(server=server),
+        )
+        frontier = RedisFrontier("redis://localhost/0", "posts")
+    yield frontier
+    frontier.close()
+
+
+def test_push_skips_seen_urls(frontier):
+    assert frontier.push([entry("a"), entry("b")]) == 2
+    assert frontier.push([entry("a"), entry("c")]) == 1
+    assert frontier.counts()["pending"] == 3
+
+
+def test_lease_by_priority(frontier):
+    frontier.push([entry("low", -5), entry("high", 5), entry("mid", 0)])
+    assert leased_urls(frontier, count=2) == ["high", "mid"]
+    assert leased_urls(frontier) == ["low"]
+    assert leased_urls(frontier) == []
+    assert frontier.counts()["leased"] == 3
+
+
+def test_done_urls_are_not_queued_again(frontier):
+    frontier.push([entry("post")])
+    leased_urls(frontier)
+    frontier.done("post")
+    assert frontier.push([entry("post")]) == 0
+    assert frontier.counts() == {"pending": 0, "leased": 0, "done": 1, "failed": 0}
+
+
+def test_revisit_queues_done_urls_again(frontier):
+    frontier.push([entry("index", revisit=True)])
+    assert frontier.push([entry("index", revisit=True)]) == 0
+    leased_urls(frontier)
+    assert frontier.push([entry("index", revisit=True)]) == 0
+    frontier.done("index")
+    assert frontier.push([entry("index", revisit=True)]) == 1
+    assert leased_urls(frontier) == ["index"]
+
+
+def test_expired_leases_are_queued_again(frontier):
+    frontier.push([entry("a")])
+    assert leased_urls(frontier, ttl=-1) == ["a"]
+    assert leased_urls(frontier) == ["a"]
+    assert leased_urls(frontier) == []
+
+
+def test_max_attempts(frontier):
+    frontier.max_attempts = 2
+    frontier.push([entry("a")])
+    assert leased_urls(frontier, ttl=-1) == ["a"]
+    assert leased_urls(frontier, ttl=-1) == ["a"]
+    assert leased_urls(frontier) == []
+    assert frontier.counts()["failed"] == 1
+
+
+def test_release(frontier):
+    frontier.max_attempts = 2
+    frontier.push([entry("a")])
+    leased_urls(frontier)
+    frontier.release("a")
+    assert frontier.counts()["pending"] == 1
+    assert leased_urls(frontier) == ["a"]
+    frontier.release("a")
+    assert frontier.counts() == {"pending": 0, "leased": 0, "done": 0, "failed": 1}
+
+
+def test_middleware_releases_failed_downloads(tmp_path):
+    frontier = SqliteFrontier(str(tmp_path / "frontier.sqlite"), "posts")
+    middleware = FrontierMiddleware(get_crawler(scrapy.Spider), frontier)
+    frontier.push([entry("http://ptt.cc/a")])
+    leased_urls(frontier)
+    request = scrapy.Request(
+        "http://ptt.cc/a", meta={"frontier_url": "http://ptt.cc/a"}
+    )
+
+    failure = Failure(HttpError(Response("http://ptt.cc/a", status=404)))
+    failure.request = request
+    assert middleware._failed(failure) is failure
+    assert frontier.counts()["leased"] == 1
+
+    failure = Failure(TimeoutError())
+    failure.request = request
+    assert middleware._failed(failure) is failure
+    assert frontier.counts()["pending"] == 1
+    frontier.close()